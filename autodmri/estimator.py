@@ -1,9 +1,11 @@
 import numpy as np
+import os
+import time
+import hashlib
 
-from scipy.ndimage.interpolation import zoom
 from scipy.special import gammaincinv
 
-from autodmri.gamma import get_noise_distribution
+from autodmri.gamma import get_noise_distribution, get_noise_distribution_from_sums
 from autodmri.blocks import extract_patches
 
 from joblib import Parallel, delayed
@@ -13,8 +15,12 @@ from tqdm import tqdm
 # These functions are for over dwis
 ###########################################
 
+# iterations used, if the estimates converged before max_iter, number of noise voxels and time spent for each slab
+diagnostics_dtype = np.dtype([('iterations', np.int32), ('converged', bool), ('mask_size', np.int64), ('time', np.float64)])
 
-def estimate_from_dwis(data, axis=-2, return_mask=False, exclude_mask=None, ncores=-1, method='moments', verbose=False, fast_median=False):
+
+def estimate_from_dwis(data, axis=-2, return_mask=False, exclude_mask=None, ncores=-1, method='moments', verbose=False, fast_median=False,
+                       max_iter=100, l=50, eps=1e-3, alpha_prob=0.05, return_diagnostics=False):
     '''Given the data, splits over each slice to compute parameters of the gamma distribution
 
     input
@@ -23,7 +29,8 @@ def estimate_from_dwis(data, axis=-2, return_mask=False, exclude_mask=None, ncor
 
     optional
     --------
-        axis : (0, 1 or 2) the axis to consider as a slab of uniform noise profile
+        axis : (0, 1 or 2) the axis to consider as a slab of uniform noise profile.
+        With 'all', estimates over the three axes at once from statistics of each voxel computed only once.
 
         return_mask : bool, if True returns the identified noise voxels as a mask
 
@@ -38,32 +45,52 @@ def estimate_from_dwis(data, axis=-2, return_mask=False, exclude_mask=None, ncor
         fast_median : Computes the median of medians from each volume.
         Useful for large datasets with many volumes (e.g. HCP) since the median requires a full copy of the data and sorting.
 
+        max_iter : int, maximum number of iterations for each slab (default 100)
+
+        l : int, number of values of sigma tried on the first iteration to find the noise voxels (default 50)
+
+        eps : float, absolute or relative change of sigma and N under which the iterations stop (default 1e-3)
+
+        alpha_prob : float, probability of wrongly rejecting a noise voxel (default 0.05)
+
+        return_diagnostics : bool, if True returns a structured array with the number of iterations, if the estimates converged,
+        the number of noise voxels and the time spent for each slab
+
     output
     -------
-    sigma, N, mask (optional)
+    sigma, N, mask (optional), diagnostics (optional)
+
+    With axis='all', sigma, N, mask and diagnostics are lists with the result for each axis
+    and the output is sigma, N, scores, mask (optional), diagnostics (optional).
+    The score of each axis is the fraction of voxels identified as noise, which is the highest along the axis where
+    the noise is the most consistent with a single distribution in each slab.
     '''
+    if max_iter < 1:
+        raise ValueError(f'max_iter must be at least 1, but is {max_iter}')
 
     # guess a gross upper bound of sigma
-    # if it's masked, median can be zero, so use the nonzero data
-    if fast_median:
-        medians = np.zeros(data.shape[-1])
+    median = _get_median(data, fast_median)
+
+    options = {'max_iter': max_iter, 'l': l, 'eps': eps, 'alpha_prob': alpha_prob, 'return_diagnostics': True}
 
-        for idx in range(data.shape[-1]):
-            chunk = data[..., idx]
-            median = np.median(chunk)
+    if axis == 'all':
+        sigma, N, scores, mask, diagnostics = _estimate_all_axes(data, median, exclude_mask, ncores, method, verbose, options)
+        output = [sigma, N, scores]
+    else:
+        sigma, N, mask, diagnostics = _estimate_axis(data, axis, median, exclude_mask, ncores, method, verbose, options)
+        output = [sigma, N]
 
-            if median == 0:
-                median = np.median(chunk[chunk > 0])
+    if return_mask:
+        output.append(mask)
 
-            medians[idx] = median
+    if return_diagnostics:
+        output.append(diagnostics)
 
-        median = np.median(medians)
-    else:
-        median = np.median(data)
+    return tuple(output)
 
-        if median == 0:
-            median = np.median(data[data > 0])
 
+def _estimate_axis(data, axis, median, exclude_mask, ncores, method, verbose, options):
+    '''Estimates over each slab along axis'''
     if axis < 0:
         axis = data.ndim + axis
 
@@ -78,86 +105,254 @@ def estimate_from_dwis(data, axis=-2, return_mask=False, exclude_mask=None, ncor
     if verbose:
         ranger = tqdm(ranger)
 
-    output = Parallel(n_jobs=ncores)(delayed(_inner)(swapped_data[i], median, exclude_mask[i], method) for i in ranger)
+    output = Parallel(n_jobs=ncores)(delayed(_inner)(swapped_data[i], median, exclude_mask[i], method, **options) for i in ranger)
 
     # output is each slice we took along axis, so the mask might be reversed
     sigma = np.zeros(len(output), dtype=np.float32)
     N = np.zeros(len(output), dtype=np.float32)
     mask = np.zeros(data.shape[:-1], dtype=np.int16).swapaxes(0, axis)
+    diagnostics = np.zeros(len(output), dtype=diagnostics_dtype)
 
     for i, s in enumerate(output):
         sigma[i] = s[0]
         N[i] = s[1]
         mask[i] = s[2]
+        diagnostics[i] = s[3]
 
-    if return_mask:
-        return sigma, N, mask.swapaxes(0, axis)
-    return sigma, N
+    return sigma, N, mask.swapaxes(0, axis), diagnostics
 
 
-def _inner(data, median, exclude_mask=None, method='moments', l=50, N_min=1, N_max=12, max_iter=100, eps=1e-3):
+def _estimate_all_axes(data, median, exclude_mask, ncores, method, verbose, options):
+    '''Estimates over the slabs of each axis, all from the same statistics of each voxel'''
+    stats = _voxel_statistics(data)
 
-    def lambda_cdf(N, alpha_prob):
-        out = gammaincinv(N, alpha_prob)
-        out = np.nan_to_num(out).clip(min=1e-7)
-        return out
+    if exclude_mask is None:
+        exclude_mask = np.zeros(data.shape[:-1], dtype=bool)
 
-    def get_mask(data, N_min, N_max, phi, alpha_prob=0.05):
-        K = data.shape[-1]
-        sum_data2 = np.sum(data**2, axis=-1)
+    ranger = [(axis, i) for axis in range(3) for i in range(data.shape[axis])]
 
-        data[data == 0] = np.nan
-        sum_data2 = np.nansum(data**2, axis=-1)
-        K = np.sum(np.isfinite(data), axis=-1)
-        data[np.isnan(data)] = 0
+    if verbose:
+        ranger = tqdm(ranger)
+
+    output = Parallel(n_jobs=ncores)(delayed(_inner_from_stats)({key: value.swapaxes(0, axis)[i] for key, value in stats.items()},
+                                                                median, exclude_mask.swapaxes(0, axis)[i], method, **options)
+                                     for axis, i in ranger)
 
-        lambda_minus = lambda_cdf(N_min*K, alpha_prob/2)
-        lambda_plus = lambda_cdf(N_max*K, 1 - alpha_prob/2)
+    sigma = [np.zeros(data.shape[axis], dtype=np.float32) for axis in range(3)]
+    N = [np.zeros(data.shape[axis], dtype=np.float32) for axis in range(3)]
+    mask = [np.zeros(data.shape[:-1], dtype=np.int16) for axis in range(3)]
+    diagnostics = [np.zeros(data.shape[axis], dtype=diagnostics_dtype) for axis in range(3)]
 
-        mask_current = np.zeros(data.shape[:-1], dtype=bool)
-        mask_loop = np.zeros(data.shape[:-1], dtype=bool)
+    for (axis, i), s in zip([(axis, i) for axis in range(3) for i in range(data.shape[axis])], output):
+        sigma[axis][i] = s[0]
+        N[axis][i] = s[1]
+        mask[axis].swapaxes(0, axis)[i] = s[2]
+        diagnostics[axis][i] = s[3]
 
-        for sigma in phi:
-            s = sum_data2 / (2*sigma**2)
-            mask_current[:] = np.logical_and(lambda_minus < s, s < lambda_plus)
+    # Voxels which could have been identified as noise in the first place
+    candidates = np.logical_and(stats['K_nonzero'] > 0, np.logical_not(exclude_mask)).sum()
+    scores = np.array([m.sum() / max(candidates, 1) for m in mask])
 
-            if mask_current.sum() > mask_loop.sum():
-                mask_loop[:] = mask_current
+    return sigma, N, scores, mask, diagnostics
 
-        return mask_loop
+
+def _inner(data, median, exclude_mask=None, method='moments', l=50, N_min=1, N_max=12, max_iter=100, eps=1e-3, alpha_prob=0.05,
+           return_diagnostics=False):
+
+    def get_mask(data, N_min, N_max, phi, alpha_prob):
+        data[data == 0] = np.nan
+        sum_data2 = np.nansum(data**2, axis=-1)
+        K = np.sum(np.isfinite(data), axis=-1)
+        data[np.isnan(data)] = 0
+
+        return _noise_mask(sum_data2, K, N_min, N_max, phi, alpha_prob)
 
     # Explicitly remove known artifacts
     if exclude_mask is None:
         exclude_mask = np.zeros(data.shape[:-1], dtype=bool)
 
     # we don't know N, so guess parameters iteratively
+    start_time = time.perf_counter()
+    converged = False
+    iteration = 0
+
     data = data.astype(np.float64)  # prevent data**4 overflow
     sigma_prev = -1
     N_prev = -1
-    sigma_init = median / np.sqrt(2 * lambda_cdf(N_max, 0.5))
+    sigma_init = median / np.sqrt(2 * _lambda_cdf(N_max, 0.5))
     phi = np.arange(1, l+1) * sigma_init / l
 
-    for _ in range(max_iter):
+    for iteration in range(1, max_iter + 1):
 
-        mask = get_mask(data, N_min, N_max, phi)
+        mask = get_mask(data, N_min, N_max, phi, alpha_prob)
         mask *= np.logical_not(exclude_mask)
 
         # empty slice -> mask is zero
         if mask.sum() == 0:
-            return 0, 0, np.zeros_like(mask)
+            sigma, N, mask = 0, 0, np.zeros_like(mask)
+            break
 
         datam = data[np.broadcast_to(mask[..., None], data.shape)]
         sigma, N = get_noise_distribution(datam, method=method)
 
         if sigma == 0 or N == 0:
-            return 0, 0, np.zeros_like(mask)
+            sigma, N, mask = 0, 0, np.zeros_like(mask)
+            break
+
+        # abs error is small?
+        if (np.abs(N - N_prev) < eps) and (np.abs(sigma - sigma_prev) < eps):
+            converged = True
+            break
+
+        # relative error is small?
+        if ((np.abs(N - N_prev) / N) < eps) and ((np.abs(sigma - sigma_prev) / sigma) < eps):
+            converged = True
+            break
+
+        N_prev = N
+        sigma_prev = sigma
+
+        N_min = N
+        N_max = N
+
+        phi = np.linspace(.95, 1.05, num=11) * sigma
+
+    if return_diagnostics:
+        return sigma, N, mask, (iteration, converged, mask.sum(), time.perf_counter() - start_time)
+    return sigma, N, mask
+
+
+def _lambda_cdf(N, alpha_prob):
+    out = gammaincinv(N, alpha_prob)
+    out = np.nan_to_num(out).clip(min=1e-7)
+    return out
+
+
+def _noise_mask(sum_data2, K, N_min, N_max, phi, alpha_prob=0.05):
+    '''Largest mask of voxels whose sum of squares over their K nonzero values is likely to be noise for one of the sigma in phi'''
+    # Most voxels have the same number of nonzero values, so only compute the bounds once for each of them
+    K_unique, K_inverse = np.unique(K, return_inverse=True)
+    lambda_minus = _lambda_cdf(N_min*K_unique, alpha_prob/2)[K_inverse].reshape(np.shape(K))
+    lambda_plus = _lambda_cdf(N_max*K_unique, 1 - alpha_prob/2)[K_inverse].reshape(np.shape(K))
+
+    mask_current = np.zeros(sum_data2.shape, dtype=bool)
+    mask_loop = np.zeros(sum_data2.shape, dtype=bool)
+
+    for sigma in phi:
+        s = sum_data2 / (2*sigma**2)
+        mask_current[:] = np.logical_and(lambda_minus < s, s < lambda_plus)
+
+        if mask_current.sum() > mask_loop.sum():
+            mask_loop[:] = mask_current
+
+    return mask_loop
+
+
+def _get_median(data, fast_median=False):
+    '''Median of the data, or of the nonzero data if it is masked. With fast_median, this is the median of the median of each volume.'''
+    if fast_median:
+        return np.median(_volume_medians(data))
+
+    median = np.median(data)
+
+    if median == 0:
+        median = np.median(data[data > 0])
+
+    return median
+
+
+def _volume_medians(data):
+    '''Median of each volume along the last axis, or of its nonzero values if it is masked.'''
+    medians = np.zeros(data.shape[-1])
+
+    for idx in range(data.shape[-1]):
+        chunk = data[..., idx]
+        median = np.median(chunk)
+
+        if median == 0:
+            median = np.median(chunk[chunk > 0])
+
+        medians[idx] = median
+
+    return medians
+
+
+def _voxel_statistics(data):
+    '''Sums over the last axis of each voxel needed by _inner_from_stats, accumulated one volume at a time.
+
+    sum_data2 and K_nonzero are over the nonzero values to find the noise voxels,
+    the other sums are over the positive values to estimate the parameters like get_noise_distribution.
+    '''
+    keys = ('sum_m', 'sum_m2', 'sum_m4', 'sum_log_m2', 'K', 'sum_data2', 'K_nonzero')
+    stats = {key: np.zeros(data.shape[:-1], dtype=np.float64) for key in keys}
+
+    for idx in range(data.shape[-1]):
+        volume = data[..., idx].astype(np.float64)  # prevent data**4 overflow
+        positive = volume > 0
+        m = np.where(positive, volume, 0)
+        m2 = m**2
+
+        stats['sum_m'] += m
+        stats['sum_m2'] += m2
+        stats['sum_m4'] += m2**2
+        stats['sum_log_m2'] += np.log(m2, out=np.zeros_like(m2), where=positive)
+        stats['K'] += positive
+        stats['sum_data2'] += volume**2
+        stats['K_nonzero'] += volume != 0
+
+    return stats
+
+
+def _inner_from_stats(stats, median, exclude_mask=None, method='moments', l=50, N_min=1, N_max=12, max_iter=100, eps=1e-3,
+                      alpha_prob=0.05, return_diagnostics=False, sigma_start=None, N_start=None):
+    '''Same as _inner, but from the statistics of each voxel of the slab given by _voxel_statistics.
+
+    If sigma_start and N_start are given, the iterations start from them instead of from scratch.
+    '''
+    if exclude_mask is None:
+        exclude_mask = np.zeros(stats['K'].shape, dtype=bool)
+
+    start_time = time.perf_counter()
+    converged = False
+    iteration = 0
+
+    sigma_prev = -1
+    N_prev = -1
+
+    if sigma_start and N_start:
+        N_min = N_start
+        N_max = N_start
+        phi = np.linspace(.95, 1.05, num=11) * sigma_start
+    else:
+        sigma_init = median / np.sqrt(2 * _lambda_cdf(N_max, 0.5))
+        phi = np.arange(1, l+1) * sigma_init / l
+
+    for iteration in range(1, max_iter + 1):
+
+        mask = _noise_mask(stats['sum_data2'], stats['K_nonzero'], N_min, N_max, phi, alpha_prob)
+        mask *= np.logical_not(exclude_mask)
+
+        # empty slice -> mask is zero
+        if mask.sum() == 0:
+            sigma, N, mask = 0, 0, np.zeros_like(mask)
+            break
+
+        sums = [stats[key][mask].sum() for key in ('sum_m', 'sum_m2', 'sum_m4', 'sum_log_m2', 'K')]
+        sigma, N = get_noise_distribution_from_sums(*sums, method=method)
+        sigma, N = float(sigma), float(N)
+
+        if sigma == 0 or N == 0:
+            sigma, N, mask = 0, 0, np.zeros_like(mask)
+            break
 
         # abs error is small?
         if (np.abs(N - N_prev) < eps) and (np.abs(sigma - sigma_prev) < eps):
+            converged = True
             break
 
         # relative error is small?
         if ((np.abs(N - N_prev) / N) < eps) and ((np.abs(sigma - sigma_prev) / sigma) < eps):
+            converged = True
             break
 
         N_prev = N
@@ -168,6 +363,8 @@ def _inner(data, median, exclude_mask=None, method='moments', l=50, N_min=1, N_m
 
         phi = np.linspace(.95, 1.05, num=11) * sigma
 
+    if return_diagnostics:
+        return sigma, N, mask, (iteration, converged, mask.sum(), time.perf_counter() - start_time)
     return sigma, N, mask
 
 
@@ -176,7 +373,9 @@ def _inner(data, median, exclude_mask=None, method='moments', l=50, N_min=1, N_m
 ###########################################
 
 
-def estimate_from_nmaps(data, size=5, return_mask=True, method='moments', full=False, ncores=-1, use_rejection=False, verbose=False):
+def estimate_from_nmaps(data, size=5, return_mask=True, method='moments', full=False, ncores=-1, use_rejection=False, verbose=False,
+                        pyramid=False, coarse_size=None, threshold=0.1, fast_median=False, return_count=False, checkpoint=None, resume=False,
+                        checkpoint_every=10000):
     '''Given the data, estimates parameters of the gamma distribution in small 3D windows.
 
     input
@@ -199,87 +398,315 @@ def estimate_from_nmaps(data, size=5, return_mask=True, method='moments', full=F
 
         verbose : bool, Shows a progress bar for parallel processing
 
+        pyramid : bool, if True first estimates in large non-overlapping windows of size coarse_size,
+        then refines with overlapping windows of size size only where the coarse estimates vary by more than threshold.
+
+        coarse_size : int, size of the coarse windows when using pyramid (default 2 * size)
+
+        threshold : float, relative change of sigma or N between neighboring coarse windows above which the estimates are refined (default 0.1)
+
+        fast_median : Computes the median of medians from each volume. The median is only needed with use_rejection.
+
+        return_count : bool, if True also returns the number of windows used for the estimates at each voxel,
+        stored in the smallest unsigned integer type which can hold size**3.
+
+        checkpoint : path of a .npz file where the partial estimates are saved after every checkpoint_every windows when full is True.
+        The file is removed once the estimation is done.
+
+        resume : bool, if True and checkpoint exists, continues from it by skipping the windows which were already estimated.
+
+        checkpoint_every : int, number of windows estimated between two saves of the checkpoint (default 10000)
+
     output
     -------
-    sigma, N, mask (optional)
+    sigma, N, mask (optional), count (optional)
     '''
-    m_out = np.zeros(data.shape[:-1], dtype=bool)
-    median = np.median(data)
+    if checkpoint is not None and (pyramid or not full):
+        raise ValueError('checkpoint can only be used with overlapping windows, with full=True and pyramid=False')
 
-    if median == 0:
-        median = np.median(data[data > 0])
+    # The median is only used as a starting point when rejecting voxels
+    if use_rejection:
+        median = _get_median(data, fast_median)
+    else:
+        median = None
 
-    if full:
-        reshaped_maps = extract_patches(data, (size, size, size, data.shape[-1]), (1, 1, 1, data.shape[-1]), flatten=False)
+    if pyramid:
+        if coarse_size is None:
+            coarse_size = 2 * size
 
-        sigma = np.zeros(data.shape[:-1], dtype=np.float32)
-        N = np.zeros(data.shape[:-1], dtype=np.float32)
-        count = np.zeros(data.shape[:-1], dtype=np.int32)
-        mask = np.zeros(data.shape[:-1], dtype=np.int32)
+        sigma, N, mask, count = _estimate_pyramid(data, size, coarse_size, threshold, median, method, use_rejection, ncores, verbose)
 
-        indexer = list(np.ndindex(reshaped_maps.shape[:reshaped_maps.ndim//2 - 1]))
+    elif full:
+        starts = list(np.ndindex(tuple(np.array(data.shape[:-1]) - size + 1)))
+        sigma, N, count, mask = _estimate_windows(data, starts, size, median, method, use_rejection, ncores, verbose,
+                                                  checkpoint=checkpoint, resume=resume, checkpoint_every=checkpoint_every)
 
-        if verbose:
-            ranger = tqdm(indexer)
-        else:
-            ranger = indexer
+        sigma /= count
+        N /= count
+
+    else:
+        s_out, N_out, mask = _estimate_grid(data, size, median, method, use_rejection, ncores, verbose)
+
+        sigma, N = _upsample((s_out, N_out), size, data.shape[:-1])
+        count = _grid_count(s_out.shape, size, data.shape[:-1])
+
+    output = [sigma, N]
+
+    if return_mask:
+        output.append(mask)
 
-        output = Parallel(n_jobs=ncores)(delayed(proc_inner)(reshaped_maps[i], median, size, method, use_rejection) for i in ranger)
+    if return_count:
+        output.append(count)
 
-        indexer = (np.index_exp[idx[0]:idx[0] + size, idx[1]:idx[1] + size, idx[2]:idx[2] + size] for idx in indexer)
+    return tuple(output)
+
+
+def _estimate_windows(data, starts, size, median, method, use_rejection, ncores, verbose, checkpoint=None, resume=False,
+                      checkpoint_every=10000):
+    '''Estimates in the overlapping windows starting at each voxel of starts and accumulates the values over the volume.
+
+    The returned sigma and N are the sums over all windows overlapping a voxel, divide them by count to get the average.
+    A voxel is in the mask if it was identified as noise in at least one window.
+
+    With a checkpoint, windows are estimated by blocks of checkpoint_every and the sums are saved after each block,
+    so that a stopped run can be resumed from the last saved block.
+    '''
+    reshaped_maps = extract_patches(data, (size, size, size, data.shape[-1]), (1, 1, 1, data.shape[-1]), flatten=False)
+
+    sigma = np.zeros(data.shape[:-1], dtype=np.float32)
+    N = np.zeros(data.shape[:-1], dtype=np.float32)
+    count = np.zeros(data.shape[:-1], dtype=np.min_scalar_type(size**3))
+    mask = np.zeros(data.shape[:-1], dtype=bool)
+
+    if checkpoint is None:
+        checkpoint_every = max(len(starts), 1)
+
+    done = 0
+
+    if checkpoint is not None:
+        run = _run_fingerprint(data, len(starts), size, median, method, use_rejection, checkpoint_every)
+
+    if checkpoint is not None and resume and os.path.isfile(checkpoint):
+        done = _load_checkpoint(checkpoint, run, sigma, N, count, mask)
+
+    if verbose:
+        progress = tqdm(total=len(starts), initial=done)
+
+    for block in range(done, len(starts), checkpoint_every):
+        block_starts = starts[block:block + checkpoint_every]
+        output = Parallel(n_jobs=ncores)(delayed(proc_inner)(reshaped_maps[i], median, size, method, use_rejection) for i in block_starts)
+
+        indexer = (np.index_exp[idx[0]:idx[0] + size, idx[1]:idx[1] + size, idx[2]:idx[2] + size] for idx in block_starts)
 
         # We accumulate the value at each voxel then take the average over the overlap
         for idx, (s, n, m) in zip(indexer, output):
             sigma[idx] += s
             N[idx] += n
 
-            mask[idx] = m.sum()
+            mask[idx] |= _window_mask(m, size)
             count[idx] += 1
 
-        sigma /= count
-        N /= count
+        done = block + len(block_starts)
+
+        if verbose:
+            progress.update(len(block_starts))
+
+        if checkpoint is not None and done < len(starts):
+            _save_checkpoint(checkpoint, run, done, sigma, N, count, mask)
+
+    if verbose:
+        progress.close()
+
+    if checkpoint is not None and os.path.isfile(checkpoint):
+        os.remove(checkpoint)
+
+    return sigma, N, count, mask
+
+
+def _run_fingerprint(data, nstarts, size, median, method, use_rejection, checkpoint_every):
+    '''Hash of the data and of every option of the run, so that a checkpoint from other data or options is never resumed.'''
+    fingerprint = hashlib.sha256()
+    median = None if median is None else float(median)
+    fingerprint.update(repr((data.shape, data.dtype.str, nstarts, size, median, method, use_rejection, checkpoint_every)).encode())
+    fingerprint.update(memoryview(np.ascontiguousarray(data)).cast('B'))
+    return fingerprint.hexdigest()
 
-        if return_mask:
-            return sigma, N, mask
-        return sigma, N
 
+def _save_checkpoint(checkpoint, run, done, sigma, N, count, mask):
+    '''Saves the partial sums to a temporary file which then replaces checkpoint, so a stopped run never leaves a broken file.'''
+    temporary = checkpoint + '.tmp'
+
+    with open(temporary, 'wb') as f:
+        np.savez(f, run=run, done=done, sigma=sigma, N=N, count=count, mask=np.packbits(mask, axis=None))
+
+    os.replace(temporary, checkpoint)
+
+
+def _load_checkpoint(checkpoint, run, sigma, N, count, mask):
+    '''Loads the partial sums from checkpoint in place and returns the number of windows already estimated.'''
+    with np.load(checkpoint) as f:
+        if str(f['run']) != run:
+            raise ValueError(f'Checkpoint {checkpoint} is from another run, with different data or options')
+
+        sigma[:] = f['sigma']
+        N[:] = f['N']
+        count[:] = f['count']
+        mask[:] = np.unpackbits(f['mask'], count=mask.size).reshape(mask.shape)
+
+        return int(f['done'])
+
+
+def _estimate_grid(data, size, median, method, use_rejection, ncores, verbose):
+    '''Estimates in non-overlapping windows and returns the values on the grid of windows with the voxelwise mask.'''
+    m_out = np.zeros(data.shape[:-1], dtype=bool)
+    reshaped_maps = extract_patches(data, (size, size, size, data.shape[-1]), (size, size, size, data.shape[-1]))
+    grid_shape = tuple(n // size for n in data.shape[:-1])
+
+    s_out = np.zeros(grid_shape, dtype=np.float32)
+    N_out = np.zeros(grid_shape, dtype=np.float32)
+
+    ranger = range(reshaped_maps.shape[0])
+
+    if verbose:
+        ranger = tqdm(ranger)
+
+    output = Parallel(n_jobs=ncores)(delayed(proc_inner)(reshaped_maps[i], median, size, method, use_rejection) for i in ranger)
+
+    # The mask of each window goes directly in the volume
+    for i, (s, n, m) in zip(np.ndindex(grid_shape), output):
+        s_out[i] = s
+        N_out[i] = n
+
+        start = np.array(i) * size
+        stop = start + size
+        m_out[start[0]:stop[0], start[1]:stop[1], start[2]:stop[2]] = _window_mask(m, size)
+
+    return s_out, N_out, m_out
+
+
+def _window_mask(m, size):
+    '''Noise voxels of a window from the mask given by proc_inner, a voxel is noise if any of its values is.'''
+    return m.reshape(size**3, -1).any(axis=-1).reshape(size, size, size)
+
+
+def _grid_count(grid_shape, size, shape):
+    '''Number of non-overlapping windows at each voxel, which is 1 inside the grid of windows and 0 in the cropped border.'''
+    count = np.zeros(shape, dtype=np.uint8)
+    count[tuple(slice(0, n * size) for n in grid_shape)] = 1
+    return count
+
+
+def _upsample(grids, size, shape):
+    '''Linearly interpolates the values estimated on grids of windows back to each voxel of a volume of the given shape.
+
+    Values are placed at the center of each window and voxels past the outermost centers, including the cropped border
+    when the shape is not divisible by size, get the value of the closest window.
+    The interpolation is done one axis at a time with the same weights for every grid.
+    '''
+    weights = [_interpolation_weights(n_windows, size, n_voxels) for n_windows, n_voxels in zip(grids[0].shape, shape)]
+    output = []
+
+    for grid in grids:
+        interpolated = np.matmul(weights[0], grid.astype(np.float32).reshape(grid.shape[0], grid.shape[1] * grid.shape[2]))
+        interpolated = interpolated.reshape(shape[0], grid.shape[1], grid.shape[2])
+        interpolated = np.matmul(weights[1], interpolated)
+        interpolated = np.matmul(interpolated, weights[2].T)
+        output.append(interpolated)
+
+    return output
+
+
+def _interpolation_weights(n_windows, size, n_voxels):
+    '''Weights of each window center for every voxel along one axis, as a (n_voxels, n_windows) array.'''
+    weights = np.zeros((n_voxels, n_windows), dtype=np.float32)
+
+    if n_windows == 0:
+        return weights
+
+    voxels = np.arange(n_voxels)
+    lower, upper, fraction = _interpolation_coordinates(n_windows, size, voxels)
+
+    weights[voxels, lower] += 1 - fraction
+    weights[voxels, upper] += fraction
+
+    return weights
+
+
+def _interpolation_coordinates(n_windows, size, voxels):
+    '''Closest window centers on each side of the voxels along one axis and how far the voxels are from the lower one.'''
+    # position of each voxel in units of windows, the first center being at 0
+    position = (np.asarray(voxels) - (size - 1) / 2) / size
+    position = position.clip(0, max(n_windows - 1, 0))
+
+    lower = np.floor(position).astype(int).clip(max=max(n_windows - 2, 0))
+    upper = np.minimum(lower + 1, n_windows - 1)
+    fraction = position - lower
+
+    return lower, upper, fraction
+
+
+def _estimate_pyramid(data, size, coarse_size, threshold, median, method, use_rejection, ncores, verbose):
+    '''Coarse to fine estimation, overlapping windows are only used where the coarse estimates vary too much.'''
+    s_coarse, N_coarse, m_out = _estimate_grid(data, coarse_size, median, method, use_rejection, ncores, verbose)
+
+    sigma, N = _upsample((s_coarse, N_coarse), coarse_size, data.shape[:-1])
+
+    # Flag the coarse windows to refine, then expand them to each voxel, including the cropped border
+    flagged = np.logical_or(_relative_gradient(s_coarse) > threshold, _relative_gradient(N_coarse) > threshold)
+
+    for axis in range(flagged.ndim):
+        flagged = flagged.repeat(coarse_size, axis=axis)
+
+    # The volume can also be too small for even one coarse window
+    if flagged.size == 0:
+        refine = np.ones(data.shape[:-1], dtype=bool)
     else:
-        reshaped_maps = extract_patches(data, (size, size, size, data.shape[-1]), (size, size, size, data.shape[-1]))
+        padding = [(0, n - f) for n, f in zip(data.shape[:-1], flagged.shape)]
+        refine = np.pad(flagged, padding, mode='edge')
 
-        sigma = np.zeros(reshaped_maps.shape[0], dtype=np.float32)
-        N = np.zeros(reshaped_maps.shape[0], dtype=np.float32)
-        mask = np.zeros((reshaped_maps.shape[0], size**3), dtype=bool)
+    count = _grid_count(s_coarse.shape, coarse_size, data.shape[:-1]).astype(np.min_scalar_type(size**3))
 
-        ranger = range(reshaped_maps.shape[0])
+    if not refine.any():
+        return sigma, N, m_out, count
 
-        if verbose:
-            ranger = tqdm(ranger)
+    # Only the windows which overlap with a voxel to refine are needed
+    needed = extract_patches(refine, (size, size, size), (1, 1, 1), flatten=False).any(axis=(-3, -2, -1))
+    starts = list(zip(*np.nonzero(needed)))
+
+    s_fine, N_fine, count_fine, m_fine = _estimate_windows(data, starts, size, median, method, use_rejection, ncores, verbose)
 
-        output = Parallel(n_jobs=ncores)(delayed(proc_inner)(reshaped_maps[i], median, size, method, use_rejection) for i in ranger)
+    refine *= count_fine > 0
+    sigma[refine] = s_fine[refine] / count_fine[refine]
+    N[refine] = N_fine[refine] / count_fine[refine]
+    m_out[refine] = m_fine[refine]
+    count[refine] = count_fine[refine]
 
-        for i, (s, n, m) in enumerate(output):
-            sigma[i] = s
-            N[i] = n
-            mask[i] = np.squeeze(m).sum(axis=-1)
+    return sigma, N, m_out, count
 
-        s_out = sigma.reshape(data.shape[0] // size, data.shape[1] // size, data.shape[2] // size)
-        N_out = N.reshape(data.shape[0] // size, data.shape[1] // size, data.shape[2] // size)
 
-        for n, i in enumerate(np.ndindex(s_out.shape)):
-            i = np.array(i) * size
-            j = i + size
-            m_out[i[0]:j[0], i[1]:j[1], i[2]:j[2]] = mask[n].reshape(size, size, size)
+def _relative_gradient(grid):
+    '''Largest change along any axis between a value and its direct neighbors relative to the value itself.
+
+    Empty values are flagged only when they are next to a non empty value, so that large regions without data are not refined.
+    '''
+    grid = grid.astype(np.float64)
+    gradient = np.zeros(grid.shape, dtype=np.float64)
+
+    # Forward and backward differences, so that a step between two values is seen in full on both sides of it
+    for axis in range(grid.ndim):
+        diff = np.abs(np.diff(grid, axis=axis))
+        before = [slice(None)] * grid.ndim
+        after = [slice(None)] * grid.ndim
+        before[axis] = slice(None, -1)
+        after[axis] = slice(1, None)
 
-        x, y, z = np.array(s_out.shape) * size
-        interpolated_sigma = np.zeros_like(data[..., 0], dtype=np.float32)
-        interpolated_N = np.zeros_like(data[..., 0], dtype=np.float32)
+        np.maximum(gradient[tuple(before)], diff, out=gradient[tuple(before)])
+        np.maximum(gradient[tuple(after)], diff, out=gradient[tuple(after)])
 
-        interpolated_sigma[:x, :y, :z] = zoom(s_out, size, order=1)
-        interpolated_N[:x, :y, :z] = zoom(N_out, size, order=1)
+    relative = np.where(gradient > 0, np.inf, 0)
+    np.divide(gradient, np.abs(grid), out=relative, where=grid != 0)
 
-        if return_mask:
-            return interpolated_sigma, interpolated_N, m_out
-        return interpolated_sigma, interpolated_N
+    return relative
 
 
 def proc_inner(cur_map, median, size, method, use_rejection):
@@ -290,7 +717,7 @@ def proc_inner(cur_map, median, size, method, use_rejection):
     else:
         cur_map = cur_map.reshape(size**3, 1, -1)
         sigma, N = get_noise_distribution(cur_map, method=method)
-        mask = np.ones_like(cur_map, dtype=bool)
+        mask = np.ones((size**3, 1), dtype=bool)
 
         if np.isnan(sigma) or np.isnan(N):
             sigma = 0
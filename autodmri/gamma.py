@@ -53,6 +53,64 @@ def get_noise_distribution(data, method='moments'):
     return sigma, N
 
 
+def get_noise_distribution_from_sums(sum_m, sum_m2, sum_m4, sum_log_m2, K, method='moments'):
+    '''Computes sigma and N from the sums over the nonzero values of gamma distributed data
+
+    This is the same as get_noise_distribution, but only needs a few sums instead of the data itself
+    and works on arrays of sums to estimate many sets of values at once.
+
+    input
+    -----
+    sum_m, sum_m2, sum_m4, sum_log_m2
+        Sums of m, m**2, m**4 and log(m**2) over the nonzero values m
+    K
+        The number of nonzero values
+    method='moments' or method='maxlk'
+        Use either the moments or maximum likelihood equations to estimate the parameters.
+
+    output
+    ------
+    sigma, N
+        arrays of parameters related to the original Gaussian noise distribution, set to 0 where they can not be estimated
+    '''
+    if method not in ('moments', 'maxlk'):
+        raise ValueError(f'Invalid method name {method}')
+
+    sums = [np.asarray(arr, dtype=np.float64) for arr in (sum_m, sum_m2, sum_m4, sum_log_m2, K)]
+    sum_m, sum_m2, sum_m4, sum_log_m2, K = np.broadcast_arrays(*sums)
+    sigma = np.zeros(K.shape)
+    N = np.zeros(K.shape)
+
+    # Same edge cases as get_noise_distribution, no voxel or only the same value
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_m = sum_m / K
+        mean_m2 = sum_m2 / K
+        variance = mean_m2 - mean_m**2
+
+    valid = (K > 0) & (variance > 1e-12 * mean_m2)
+
+    if not np.any(valid):
+        return sigma, N
+
+    K = K[valid]
+    mean_m2 = mean_m2[valid]
+    mean_m4 = sum_m4[valid] / K
+    mean_log_m2 = sum_log_m2[valid] / K
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if method == 'moments':
+            s = np.sqrt(mean_m4 / mean_m2 - mean_m2) / np.sqrt(2)
+            n = mean_m2 / (2*s**2)
+        else:
+            s = _maxlk_sigma_from_sums(sum_m2[valid], sum_log_m2[valid], K, np.sqrt(variance[valid]))
+            n = _inv_digamma_array(mean_log_m2 - np.log(2*s**2))
+
+    sigma[valid] = s
+    N[valid] = n
+
+    return sigma, N
+
+
 def maxlk_sigma(m, xold=None, eps=1e-8, max_iter=100):
     '''Maximum likelihood equation to estimate sigma from gamma distributed values'''
 
@@ -99,3 +157,54 @@ def inv_digamma(y, eps=1e-8, max_iter=100):
         xold = xnew
 
     return xnew
+
+
+def _maxlk_sigma_from_sums(sum_m2, sum_log_m2, K, xold, eps=1e-8, max_iter=100):
+    '''Same as maxlk_sigma, but from the sums over each set of values so that all of them are solved at once'''
+
+    def f(sigma, sum_m2, sum_log_m2, K):
+        return digamma(sum_m2/(2*K*sigma**2)) - sum_log_m2/K + np.log(2*sigma**2)
+
+    def fprime(sigma, sum_m2, K):
+        return -sum_m2 * polygamma(1, sum_m2/(2*K*sigma**2)) / (K*sigma**3) + 2/sigma
+
+    xold = np.array(xold, dtype=np.float64)
+    xnew = xold.copy()
+    active = np.ones(xold.shape, dtype=bool)
+
+    for _ in range(max_iter):
+        x = xold[active]
+        sums = sum_m2[active], sum_log_m2[active], K[active]
+
+        xnew[active] = x - f(x, *sums) / fprime(x, sums[0], sums[2])
+
+        converged = np.abs(x - xnew[active]) < eps
+        xold[active] = xnew[active]
+        active[active] = ~converged
+
+        if not np.any(active):
+            break
+
+    return xnew
+
+
+def _inv_digamma_array(y, eps=1e-8, max_iter=100):
+    '''Same as inv_digamma, but for an array of values'''
+
+    y = np.asarray(y, dtype=np.float64)
+    xold = np.where(y >= -2.22, np.exp(y) + 0.5, -1 / (y - digamma(1)))
+    xnew = xold.copy()
+    active = np.ones(y.shape, dtype=bool)
+
+    for _ in range(max_iter):
+        x = xold[active]
+        xnew[active] = x - (digamma(x) - y[active]) / polygamma(1, x)
+
+        converged = np.abs(x - xnew[active]) < eps
+        xold[active] = xnew[active]
+        active[active] = ~converged
+
+        if not np.any(active):
+            break
+
+    return xnew
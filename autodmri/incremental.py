@@ -0,0 +1,119 @@
+import numpy as np
+
+from autodmri.estimator import _get_median, _voxel_statistics, _inner_from_stats
+
+from joblib import Parallel, delayed
+from tqdm import tqdm
+
+
+class IncrementalEstimator():
+    '''Estimation over slabs like estimate_from_dwis, which can be quickly repeated with a different exclude_mask.
+
+    The median and the sums needed from each voxel are computed once, so the data is not needed anymore afterwards.
+    Each new call to estimate only goes over the slabs where exclude_mask changed since the previous call,
+    starting from their previous estimates, while the other slabs are kept as they were.
+
+    input
+    ------
+        data : array, input volume used to identify noise voxels and estimate the noise distribution
+
+    optional
+    --------
+        axis : (0, 1 or 2) the axis to consider as a slab of uniform noise profile
+
+        method='moments' or method='maxlk' : which algorithm to use to estimate sigma and N
+
+        ncores : int, number of cores to use for multiprocessing
+
+        verbose : bool, Shows a progress bar for parallel processing
+
+        fast_median : Computes the median of medians from each volume.
+
+        max_iter, l, eps, alpha_prob : controls of the iterations for each slab, see estimate_from_dwis
+    '''
+
+    def __init__(self, data, axis=-2, method='moments', ncores=-1, verbose=False, fast_median=False, max_iter=100, l=50, eps=1e-3,
+                 alpha_prob=0.05):
+        if max_iter < 1:
+            raise ValueError(f'max_iter must be at least 1, but is {max_iter}')
+
+        if axis < 0:
+            axis = data.ndim + axis
+
+        self.axis = axis
+        self.method = method
+        self.ncores = ncores
+        self.verbose = verbose
+        self.options = {'max_iter': max_iter, 'l': l, 'eps': eps, 'alpha_prob': alpha_prob}
+        self.median = _get_median(data, fast_median)
+        self.stats = _voxel_statistics(data)
+
+        self.exclude_mask = None
+        self.sigma = None
+        self.N = None
+        self.mask = None
+
+    def estimate(self, exclude_mask=None, return_mask=False, warm_start=True):
+        '''Estimates sigma and N for each slab, only updating the slabs where exclude_mask changed since the last call.
+
+        input
+        ------
+            exclude_mask : array, mask indicating voxels to remove from all the computations, such as those containing huge artifacts.
+
+            return_mask : bool, if True returns the identified noise voxels as a mask
+
+            warm_start : bool, if True the slabs which changed start from their previous estimates instead of from scratch
+
+        output
+        -------
+        sigma, N, mask (optional)
+        '''
+        shape = self.stats['K'].shape
+        nslabs = shape[self.axis]
+
+        if exclude_mask is None:
+            exclude_mask = np.zeros(shape, dtype=bool)
+        else:
+            exclude_mask = np.asarray(exclude_mask, dtype=bool)
+
+        if self.sigma is None:
+            self.sigma = np.zeros(nslabs, dtype=np.float32)
+            self.N = np.zeros(nslabs, dtype=np.float32)
+            self.mask = np.zeros(shape, dtype=np.int16)
+            slabs = np.arange(nslabs)
+            warm_start = False
+        else:
+            changed = np.logical_xor(exclude_mask, self.exclude_mask)
+            other_axes = tuple(ax for ax in range(changed.ndim) if ax != self.axis)
+            slabs = np.flatnonzero(changed.any(axis=other_axes))
+
+        if warm_start:
+            start = [(self.sigma[i], self.N[i]) for i in slabs]
+        else:
+            start = [(None, None)] * len(slabs)
+
+        ranger = zip(slabs, start)
+
+        if self.verbose:
+            ranger = tqdm(ranger, total=len(slabs))
+
+        swapped_stats = {key: value.swapaxes(0, self.axis) for key, value in self.stats.items()}
+        swapped_exclude = exclude_mask.swapaxes(0, self.axis)
+
+        output = Parallel(n_jobs=self.ncores)(delayed(_inner_from_stats)({key: value[i] for key, value in swapped_stats.items()},
+                                                                          self.median, swapped_exclude[i], self.method,
+                                                                          sigma_start=sigma_start, N_start=N_start, **self.options)
+                                              for i, (sigma_start, N_start) in ranger)
+
+        swapped_mask = self.mask.swapaxes(0, self.axis)
+
+        for i, s in zip(slabs, output):
+            self.sigma[i] = s[0]
+            self.N[i] = s[1]
+            swapped_mask[i] = s[2]
+
+        self.exclude_mask = exclude_mask.copy()
+
+        if return_mask:
+            return self.sigma.copy(), self.N.copy(), self.mask.copy()
+        return self.sigma.copy(), self.N.copy()
@@ -0,0 +1,159 @@
+import numpy as np
+
+from itertools import product
+
+from autodmri.estimator import estimate_from_dwis, estimate_from_nmaps
+from autodmri.estimator import _estimate_grid, _get_median, _upsample, _interpolation_coordinates
+
+
+class NoiseDistribution():
+    '''Estimated sigma and N kept in their compact form and only expanded to the whole volume on demand.
+
+    Depending on how they were estimated, sigma and N are stored as
+        - one value per slab along axis, from estimate_from_dwis
+        - one value per window on a grid of non-overlapping windows of a given size, from estimate_from_nmaps
+        - one value per voxel, from estimate_from_nmaps with overlapping windows
+
+    The mask of noise voxels is stored bit-packed.
+    Use the classmethods from_dwis and from_nmaps to estimate directly into this representation.
+
+    input
+    ------
+        sigma, N : arrays of estimated values, either per slab, per window or per voxel
+
+        shape : the 3D shape of the volume the values were estimated from
+
+    optional
+    --------
+        mask : array, identified noise voxels
+
+        axis : (0, 1 or 2) the axis of the slabs when sigma and N have one value per slab
+
+        size : size of the windows when sigma and N have one value per non-overlapping window
+    '''
+
+    def __init__(self, sigma, N, shape, mask=None, axis=None, size=None):
+        self.sigma = np.asarray(sigma)
+        self.N = np.asarray(N)
+        self.shape = tuple(shape)
+        self.axis = axis
+        self.size = size
+
+        if axis is not None:
+            self.layout = 'slab'
+        elif size is not None:
+            self.layout = 'grid'
+        else:
+            self.layout = 'voxel'
+
+        if mask is None:
+            self.packed_mask = None
+        else:
+            self.packed_mask = np.packbits(np.asarray(mask, dtype=bool), axis=None)
+
+    @classmethod
+    def from_dwis(cls, data, axis=-2, **kwargs):
+        '''Estimates over slabs with estimate_from_dwis, the other keywords arguments are passed along.
+
+        Only a single axis is supported, and the mask is always kept while diagnostics are not,
+        use estimate_from_dwis directly for axis='all' or return_diagnostics.
+        '''
+        for key in ('return_mask', 'return_diagnostics'):
+            if key in kwargs:
+                raise TypeError(f'from_dwis() does not accept {key}, use estimate_from_dwis instead')
+
+        if axis == 'all':
+            raise ValueError("from_dwis() estimates along a single axis, use estimate_from_dwis for axis='all'")
+
+        if axis < 0:
+            axis = data.ndim + axis
+
+        sigma, N, mask = estimate_from_dwis(data, axis=axis, return_mask=True, **kwargs)
+        return cls(sigma, N, data.shape[:-1], mask=mask, axis=axis)
+
+    @classmethod
+    def from_nmaps(cls, data, size=5, full=False, pyramid=False, method='moments', ncores=-1, use_rejection=False, verbose=False,
+                   fast_median=False, **kwargs):
+        '''Estimates over windows with estimate_from_nmaps, the other keywords arguments are passed along.
+
+        They only apply to overlapping windows or to pyramid, such as coarse_size, threshold or checkpoint,
+        and raise a TypeError with non-overlapping windows.
+        '''
+        if 'return_count' in kwargs:
+            raise TypeError('from_nmaps() does not return the count, use estimate_from_nmaps instead')
+
+        if full or pyramid:
+            sigma, N, mask = estimate_from_nmaps(data, size=size, return_mask=True, method=method, full=full, ncores=ncores,
+                                                 use_rejection=use_rejection, verbose=verbose, pyramid=pyramid,
+                                                 fast_median=fast_median, **kwargs)
+            return cls(sigma, N, data.shape[:-1], mask=mask)
+
+        if kwargs:
+            raise TypeError(f'from_nmaps() got keyword arguments {", ".join(sorted(kwargs))} which do not apply to non-overlapping windows')
+
+        if use_rejection:
+            median = _get_median(data, fast_median)
+        else:
+            median = None
+
+        sigma, N, mask = _estimate_grid(data, size, median, method, use_rejection, ncores, verbose)
+        return cls(sigma, N, data.shape[:-1], mask=mask, size=size)
+
+    @property
+    def mask(self):
+        '''The noise voxels unpacked as a boolean volume, or None if there is no mask.'''
+        if self.packed_mask is None:
+            return None
+
+        nvoxels = int(np.prod(self.shape))
+        return np.unpackbits(self.packed_mask)[:nvoxels].reshape(self.shape).astype(bool)
+
+    def sigma_map(self, dtype=np.float32):
+        '''Sigma at every voxel, as a read-only broadcast view when estimated over slabs.'''
+        return self._expand(self.sigma, dtype)
+
+    def N_map(self, dtype=np.float32):
+        '''N at every voxel, as a read-only broadcast view when estimated over slabs.'''
+        return self._expand(self.N, dtype)
+
+    def sigma_at(self, index):
+        '''Sigma at some voxels only, index is a tuple of coordinates along each axis such as the output of np.nonzero.'''
+        return self._values_at(self.sigma, index)
+
+    def N_at(self, index):
+        '''N at some voxels only, index is a tuple of coordinates along each axis such as the output of np.nonzero.'''
+        return self._values_at(self.N, index)
+
+    def _expand(self, values, dtype):
+        values = values.astype(dtype, copy=False)
+
+        if self.layout == 'slab':
+            newshape = [1] * len(self.shape)
+            newshape[self.axis] = -1
+            return np.broadcast_to(values.reshape(newshape), self.shape)
+
+        if self.layout == 'grid':
+            return _upsample((values,), self.size, self.shape)[0].astype(dtype, copy=False)
+
+        return values
+
+    def _values_at(self, values, index):
+        if self.layout == 'slab':
+            return values[index[self.axis]]
+
+        if self.layout == 'voxel':
+            return values[tuple(index)]
+
+        if values.size == 0:
+            return np.zeros(np.broadcast(*index).shape, dtype=np.float32)
+
+        # Same linear interpolation as the full volume, but only from the 8 closest window centers of each voxel
+        coordinates = [_interpolation_coordinates(n_windows, self.size, voxels) for n_windows, voxels in zip(values.shape, index)]
+        output = 0
+
+        for corner in product((0, 1), repeat=3):
+            indices = tuple(upper if c else lower for c, (lower, upper, _) in zip(corner, coordinates))
+            weights = np.prod([fraction if c else 1 - fraction for c, (_, _, fraction) in zip(corner, coordinates)], axis=0)
+            output = output + weights * values[indices]
+
+        return output
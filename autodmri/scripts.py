@@ -5,7 +5,11 @@ import os
 import argparse
 import logging
 
-from autodmri.estimator import estimate_from_dwis, estimate_from_nmaps
+from autodmri.estimator import estimate_from_dwis, estimate_from_nmaps, diagnostics_dtype
+from autodmri.result import NoiseDistribution
+from autodmri.streaming import NoiseMapsAccumulator
+
+from tqdm import tqdm
 
 
 DESCRIPTION = """
@@ -36,6 +40,22 @@ class CustomFormatter(argparse.ArgumentDefaultsHelpFormatter, argparse.RawTextHe
     pass
 
 
+def axis_type(value):
+    if value == 'all':
+        return value
+    return int(value)
+
+
+def add_suffix(filename, suffix):
+    '''Adds suffix to filename before its extension, taking care of .nii.gz'''
+    for ext in ('.nii.gz', '.nii'):
+        if filename.endswith(ext):
+            return filename[:-len(ext)] + suffix + ext
+
+    root, ext = os.path.splitext(filename)
+    return root + suffix + ext
+
+
 def buildArgsParser():
 
     p = argparse.ArgumentParser(description=DESCRIPTION,
@@ -54,8 +74,11 @@ def buildArgsParser():
     p.add_argument('mask', metavar='mask',
                    help='Path of the output mask for voxels identified as noise.')
 
-    p.add_argument('-a', '--axis', type=int, default=-2, choices=[0, 1, 2],
-                   help='Axis (0, 1 or 2 typically) which is assumed to contain uniform noise.')
+    p.add_argument('-a', '--axis', type=axis_type, default=-2, choices=[0, 1, 2, 'all'],
+                   help='Axis (0, 1 or 2 typically) which is assumed to contain uniform noise.\n'
+                        'With "all", estimates over the three axes at once and writes the outputs of each axis with the suffix _axis0, _axis1 and _axis2.\n'
+                        'The fraction of voxels identified as noise along each axis is also shown with option --verbose,\n'
+                        'the highest one being the axis where most voxels agree with a single noise distribution per slab.')
 
     p.add_argument('-m', '--method', default='moments', choices=['moments', 'maxlk'], metavar='string',
                    help='Method to use for estimating parameters, either "moments" or "maxlk".')
@@ -72,9 +95,58 @@ def buildArgsParser():
     p.add_argument('--subsample', action='store_true',
                    help='If supplied, estimate in non-overlapping windows with option --noise_maps.')
 
+    p.add_argument('--stream', action='store_true',
+                   help='If supplied with option --noise_maps, read the noise maps one volume at a time and only keep running sums in memory.\n'
+                        'Useful for noise maps with many repetitions.')
+
+    p.add_argument('--pyramid', action='store_true',
+                   help='If supplied with option --noise_maps, first estimate in large non-overlapping windows\n'
+                        'and only refine with overlapping windows where the estimates vary too much.')
+
+    p.add_argument('--coarse_size', metavar='int', type=int,
+                   help='Size of the large windows used with option --pyramid. Defaults to twice the value of --size.')
+
+    p.add_argument('--threshold', metavar='float', type=float, default=0.1,
+                   help='Relative change of sigma or N between neighboring large windows above which estimates are refined with option --pyramid.')
+
     p.add_argument('--fast_median', action='store_true',
                    help='If supplied, computes the median of medians from each volume instead of one median value.\n'
-                      'Useful for large datasets with many volumes (e.g. HCP) since the median requires a full copy of the data and sorting.')
+                      'Useful for large datasets with many volumes (e.g. HCP) since the median requires a full copy of the data and sorting.\n'
+                      'With option --noise_maps, the median is only needed when rejecting voxels.')
+
+    p.add_argument('--max_iter', metavar='int', type=int, default=100,
+                   help='Maximum number of iterations for estimating over each slab.')
+
+    p.add_argument('--eps', metavar='float', type=float, default=1e-3,
+                   help='Absolute or relative change of sigma and N between two iterations under which the estimation of a slab stops.')
+
+    p.add_argument('--alpha', metavar='float', type=float, default=0.05, dest='alpha_prob',
+                   help='Probability of wrongly rejecting a noise voxel when identifying noise voxels in each slab.')
+
+    p.add_argument('--nsigmas', metavar='int', type=int, default=50, dest='l',
+                   help='Number of values of sigma tried on the first iteration to identify noise voxels in each slab.')
+
+    p.add_argument('--diagnostics', metavar='file',
+                   help='Save the number of iterations, if the estimates converged, the number of noise voxels\n'
+                        'and the time spent for each slab to this comma separated text file.')
+
+    p.add_argument('--count', metavar='file',
+                   help='Save the number of windows used for the estimates at each voxel to this file, only with --noise_maps.')
+
+    p.add_argument('--packed_mask', metavar='file',
+                   help='Also save the mask of noise voxels packed in bits to this .npz file, with the arrays mask, shape and affine.\n'
+                        'The extension .npz is added if it is missing.\n'
+                        'Load it back with np.unpackbits(f["mask"], count=np.prod(f["shape"])).reshape(f["shape"]).')
+
+    p.add_argument('--checkpoint', metavar='file',
+                   help='Save the partial estimates of overlapping windows with --noise_maps to this .npz file while running,\n'
+                        'so that a stopped run can be continued with --resume. The file is removed once the estimation is done.')
+
+    p.add_argument('--resume', action='store_true',
+                   help='Continue from the file given with --checkpoint if it exists, skipping the windows already estimated.')
+
+    p.add_argument('--checkpoint_every', metavar='int', type=int, default=10000,
+                   help='Number of windows estimated between two saves of the checkpoint.')
 
     p.add_argument('--size', metavar='int', type=int, default=5,
                    help='Size of the window for local noise maps estimation.')
@@ -95,6 +167,10 @@ def main():
     parser = buildArgsParser()
     args = parser.parse_args()
 
+    # np.savez adds the extension otherwise, which would not be the file checked for overwriting
+    if args.packed_mask is not None and not args.packed_mask.endswith('.npz'):
+        args.packed_mask += '.npz'
+
     logger = logging.getLogger('autodmri')
 
     if args.logfile is not None:
@@ -111,9 +187,17 @@ def main():
         logger.setLevel(logging.INFO)
         logger.info('Verbosity is on')
 
-    overwritable_files = [args.sigma,
-                          args.N,
-                          args.mask]
+    if args.axis == 'all' and not args.noise_maps:
+        outputs = [[None if f is None else add_suffix(f, f'_axis{axis}') for f in (args.sigma, args.N, args.mask, args.packed_mask, args.count)]
+                   for axis in range(3)]
+    else:
+        outputs = [[args.sigma, args.N, args.mask, args.packed_mask, args.count]]
+
+    overwritable_files = [f for files in outputs for f in files] + [args.diagnostics]
+
+    # An existing checkpoint is only kept with --resume, otherwise it would be replaced by the new run
+    if not args.resume:
+        overwritable_files.append(args.checkpoint)
 
     for f in overwritable_files:
         if f is not None and os.path.isfile(f):
@@ -122,9 +206,35 @@ def main():
             else:
                 parser.error(f'{f} already exists! Use -f or --force to overwrite it.')
 
-    vol = nib.load(args.data)
-    data = vol.get_fdata(dtype=np.float32)
+    if args.stream and args.pyramid:
+        parser.error('Options --stream and --pyramid can not be used together.')
+
+    if args.count is not None and not args.noise_maps:
+        parser.error('Option --count can only be used with --noise_maps.')
+
+    if args.max_iter < 1:
+        parser.error(f'Option --max_iter must be at least 1, but is {args.max_iter}.')
+
+    # These only control the estimation over slabs
+    slab_options = {'max_iter': '--max_iter', 'eps': '--eps', 'alpha_prob': '--alpha', 'l': '--nsigmas', 'diagnostics': '--diagnostics'}
+    changed = [option for dest, option in slab_options.items() if getattr(args, dest) != parser.get_default(dest)]
+
+    if args.noise_maps and changed:
+        parser.error(f'Options {", ".join(changed)} can not be used with --noise_maps.')
+
+    if args.checkpoint is not None and (not args.noise_maps or args.subsample or args.pyramid or args.stream):
+        parser.error('Option --checkpoint can only be used with --noise_maps and overlapping windows.')
+
+    if args.resume and args.checkpoint is None:
+        parser.error('Option --resume needs a file given with --checkpoint.')
+
+    # Keeping the file open lets each volume of a gzipped file be read without decompressing it again from the start
+    vol = nib.load(args.data, keep_file_open=args.noise_maps and args.stream)
     aff = vol.affine
+
+    # Streamed noise maps are read one volume at a time later on
+    if not (args.noise_maps and args.stream):
+        data = vol.get_fdata(dtype=np.float32)
     # hdr = vol.header
 
     ncores = args.ncores
@@ -143,19 +253,45 @@ def main():
     logger.info(f'Now estimating over file {args.data} with method = {method} and axis = {axis}')
 
     if noise_maps:
-        if full:
+        if args.pyramid:
+            overlap = 'refinement of non-overlapping windows'
+        elif full:
             overlap = 'overlapping windows'
         else:
             overlap = 'non-overlapping windows'
 
-        if data.ndim == 3:
-            data = data[..., None]
-
         logger.info(f'Estimation will be done over noise maps with a window of size {size} and {overlap}')
-        sigma, N, mask = estimate_from_nmaps(data, size=size, return_mask=True, method=method, full=full, ncores=ncores, use_rejection=False, verbose=args.verbose)
+
+        if args.stream:
+            nvolumes = vol.shape[-1] if len(vol.shape) == 4 else 1
+            logger.info(f'Reading the {nvolumes} volumes of the noise maps one at a time')
+
+            accumulator = NoiseMapsAccumulator(vol.shape[:3], size=size, full=full)
+            ranger = range(nvolumes)
+
+            if args.verbose:
+                ranger = tqdm(ranger)
+
+            for idx in ranger:
+                if len(vol.shape) == 4:
+                    volume = vol.dataobj[..., idx]
+                else:
+                    volume = vol.dataobj[:]
+
+                accumulator.update(np.asarray(volume, dtype=np.float32))
+
+            estimates = [accumulator.estimate(method=method, return_mask=True, return_count=True)]
+        else:
+            if data.ndim == 3:
+                data = data[..., None]
+
+            estimates = [estimate_from_nmaps(data, size=size, return_mask=True, method=method, full=full, ncores=ncores, use_rejection=False,
+                                             verbose=args.verbose, pyramid=args.pyramid, coarse_size=args.coarse_size, threshold=args.threshold,
+                                             fast_median=args.fast_median, return_count=True, checkpoint=args.checkpoint, resume=args.resume,
+                                             checkpoint_every=args.checkpoint_every)]
 
     else:
-        if axis < 0:
+        if axis != 'all' and axis < 0:
             axis = data.ndim + axis
 
         if args.fast_median:
@@ -164,34 +300,63 @@ def main():
             logger.warning(f'Estimation of the median will be done over the whole volume, but you have {data.shape[-1]} volumes.\n' +
                            '\tConsider the option --fast_median if memory usage is high and startup time is too long.')
 
-        sigma, N, mask = estimate_from_dwis(data, axis=axis, return_mask=True, exclude_mask=exclude_mask, ncores=ncores,
-                                            method=method, verbose=args.verbose, fast_median=args.fast_median)
-
-        # Broadcast the 1D arrays to full 3D
-        if axis == 0:
-            sigma = sigma[:, None, None]
-            N = N[:, None, None]
-        elif axis == 1:
-            sigma = sigma[None, :, None]
-            N = N[None, :, None]
-        elif axis == 2:
-            sigma = sigma[None, None, :]
-            N = N[None, None, :]
+        options = {'max_iter': args.max_iter, 'eps': args.eps, 'alpha_prob': args.alpha_prob, 'l': args.l}
+
+        if axis == 'all':
+            sigma, N, scores, mask, diagnostics = estimate_from_dwis(data, axis=axis, return_mask=True, exclude_mask=exclude_mask, ncores=ncores,
+                                                                     method=method, verbose=args.verbose, fast_median=args.fast_median,
+                                                                     return_diagnostics=True, **options)
+
+            for ax, score in enumerate(scores):
+                logger.info(f'Fraction of voxels identified as noise along axis {ax} is {score:.4f}')
+            logger.info(f'Most voxels are identified as noise along axis {np.argmax(scores)}')
+
+            results = [NoiseDistribution(sigma[ax], N[ax], data.shape[:-1], mask=mask[ax], axis=ax) for ax in range(3)]
+            axes = [0, 1, 2]
         else:
-            raise ValueError(f'axis = {axis} is not 0, 1 or 2, but that should never happen!')
+            sigma, N, mask, diagnostics = estimate_from_dwis(data, axis=axis, return_mask=True, exclude_mask=exclude_mask, ncores=ncores,
+                                                             method=method, verbose=args.verbose, fast_median=args.fast_median,
+                                                             return_diagnostics=True, **options)
+
+            results = [NoiseDistribution(sigma, N, data.shape[:-1], mask=mask, axis=axis)]
+            sigma, N, diagnostics = [sigma], [N], [diagnostics]
+            axes = [axis]
+
+        for ax, diag in zip(axes, diagnostics):
+            unconverged = np.sum(~diag['converged'] & (diag['mask_size'] > 0))
+
+            if unconverged > 0:
+                logger.warning(f'{unconverged} slabs along axis {ax} did not converge in {args.max_iter} iterations')
+
+        if args.diagnostics is not None:
+            logger.info(f'Saving diagnostics for each slab to {args.diagnostics}')
+            rows = [(ax, i, s, n) + tuple(d) for ax, sig, nn, diag in zip(axes, sigma, N, diagnostics)
+                    for i, (s, n, d) in enumerate(zip(sig, nn, diag))]
+            header = 'axis,slab,sigma,N,' + ','.join(diagnostics_dtype.names)
+            np.savetxt(args.diagnostics, rows, fmt=['%d', '%d', '%.6g', '%.6g', '%d', '%d', '%d', '%.6f'], delimiter=',', header=header, comments='')
 
-        sigma = np.ones(mask.shape) * sigma
-        N = np.ones(mask.shape) * N
+        # Only a view of the 1D arrays over the full 3D volume, it is written without a full copy
+        estimates = [(result.sigma_map(), result.N_map(), result.mask, None) for result in results]
 
     # Save the data
-    logger.info(f'Output files are {args.sigma}, {args.N} and {args.mask}')
-    mask = mask.astype(np.int16)
-    sigma = sigma.astype(np.float32)
-    N = N.astype(np.float32)
-
-    nib.Nifti1Image(sigma, aff).to_filename(args.sigma)
-    nib.Nifti1Image(N, aff).to_filename(args.N)
-    nib.Nifti1Image(mask, aff).to_filename(args.mask)
+    for (sigma, N, mask, count), (sigma_file, N_file, mask_file, packed_file, count_file) in zip(estimates, outputs):
+        logger.info(f'Output files are {sigma_file}, {N_file} and {mask_file}')
+        mask = mask.astype(np.uint8)
+        sigma = sigma.astype(np.float32, copy=False)
+        N = N.astype(np.float32, copy=False)
+
+        nib.Nifti1Image(sigma, aff).to_filename(sigma_file)
+        nib.Nifti1Image(N, aff).to_filename(N_file)
+        nib.Nifti1Image(mask, aff).to_filename(mask_file)
+
+        if packed_file is not None:
+            logger.info(f'Saving the mask packed in bits to {packed_file}')
+            np.savez(packed_file, mask=np.packbits(mask, axis=None), shape=mask.shape, affine=aff)
+
+        # The count is stored as uint8 or uint16 depending on the size of the windows
+        if count_file is not None:
+            logger.info(f'Saving the number of windows at each voxel to {count_file}')
+            nib.Nifti1Image(count, aff).to_filename(count_file)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,342 @@
+import numpy as np
+import nibabel as nib
+
+import os
+import time
+import queue
+import argparse
+import logging
+import threading
+
+from joblib import Parallel, delayed, parallel_backend
+
+from autodmri.estimator import estimate_from_nmaps
+from autodmri.result import NoiseDistribution
+
+
+DESCRIPTION = """
+Watches a directory and estimates the noise distribution of each new nifti file as soon as it is written.
+The outputs are written next to each input with the suffixes _sigma, _N and _mask.
+Python, the modules and the pool of processes stay loaded between files, so each estimation starts right away.
+"""
+
+logger = logging.getLogger('autodmri')
+
+# joblib stops the processes of its pool after 300 s without work by default, the service keeps them for a week
+# which is also well below the largest timeout the processes can wait for
+idle_worker_timeout = 7 * 24 * 3600
+
+extensions = ('.nii.gz', '.nii')
+suffixes = ('_sigma', '_N', '_mask')
+
+
+def output_files(filename):
+    '''Files written next to filename by estimate_file, or None if filename is not a nifti file.'''
+    for ext in extensions:
+        if filename.endswith(ext):
+            root = filename[:-len(ext)]
+            return [root + suffix + ext for suffix in suffixes]
+
+    return None
+
+
+def estimate_file(filename, noise_maps=False, method='moments', axis=-2, size=5, full=True, ncores=-1, fast_median=False):
+    '''Estimates sigma and N from a nifti file and writes them next to it.
+
+    input
+    ------
+        filename : path of the nifti file
+
+    optional
+    --------
+        noise_maps : bool, if True the file contains noise maps and the estimation is done with estimate_from_nmaps,
+        otherwise it is done over slabs with estimate_from_dwis
+
+        method, axis, size, full, ncores, fast_median : options of estimate_from_dwis or estimate_from_nmaps
+
+    output
+    -------
+    the sigma, N and mask output files
+    '''
+    vol = nib.load(filename)
+    data = vol.get_fdata(dtype=np.float32)
+
+    if noise_maps:
+        if data.ndim == 3:
+            data = data[..., None]
+
+        sigma, N, mask = estimate_from_nmaps(data, size=size, method=method, full=full, ncores=ncores, fast_median=fast_median)
+    else:
+        result = NoiseDistribution.from_dwis(data, axis=axis, method=method, ncores=ncores, fast_median=fast_median)
+        sigma, N, mask = result.sigma_map(), result.N_map(), result.mask
+
+    outputs = output_files(filename)
+    arrays = (sigma.astype(np.float32, copy=False), N.astype(np.float32, copy=False), mask.astype(np.uint8))
+
+    # Each output is written to a hidden file first and then renamed, so that nobody ever sees a partially written output
+    for array, output in zip(arrays, outputs):
+        temporary = os.path.join(os.path.dirname(output), '.' + os.path.basename(output))
+        nib.Nifti1Image(array, vol.affine).to_filename(temporary)
+        os.replace(temporary, output)
+
+    return outputs
+
+
+class EstimationService():
+    '''Estimates the noise distribution of each new nifti file of a directory with a few worker threads.
+
+    The directory is checked every interval seconds and a file is processed once its size and modification time
+    stayed the same between two checks, so that files still being copied are not read.
+    At most queue_size files wait to be processed, the others are picked up on a later check.
+    A file is processed again when its size or modification time changed since it was read for the previous estimation,
+    including a file which could not be processed. Files which already had all their outputs when the service started,
+    the outputs of other files and hidden files are skipped.
+    done has the size and modification time of each file when it was read with the output files, or the error.
+    Files can also be given directly with submit.
+
+    The pool of processes used by each worker is started by start and kept alive until the service stops.
+
+    input
+    ------
+        directory : the directory to watch
+
+    optional
+    --------
+        nworkers : int, number of files processed at the same time
+
+        queue_size : int, maximum number of files waiting to be processed
+
+        interval : float, time in seconds between two checks of the directory
+
+        The other keywords arguments are passed along to estimate_file.
+    '''
+
+    def __init__(self, directory, nworkers=2, queue_size=8, interval=1., **options):
+        self.directory = directory
+        self.nworkers = nworkers
+        self.interval = interval
+        self.options = options
+
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.done = {}
+
+        self._seen = {}
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        '''Starts the pool of processes, then watches the directory and processes files in background threads.'''
+        self._stop.clear()
+
+        with self._pool():
+            ncores = self.options.get('ncores', -1)
+            Parallel(n_jobs=ncores)(delayed(abs)(idx) for idx in range(max(ncores, 1) * 2))
+        self._threads = [threading.Thread(target=self._work, daemon=True) for _ in range(self.nworkers)]
+        self._threads.append(threading.Thread(target=self._watch, daemon=True))
+
+        for thread in self._threads:
+            thread.start()
+
+        logger.info(f'Watching {os.path.realpath(self.directory)} with {self.nworkers} workers')
+
+    def stop(self):
+        '''Stops once the files currently being processed are done, files still waiting in the queue are not processed.'''
+        self._stop.set()
+
+        for thread in self._threads:
+            thread.join()
+
+        self._threads = []
+
+    def submit(self, filename, block=True):
+        '''Adds a file to the queue, waiting for a free spot if block is True, and returns if it was added.'''
+        with self._lock:
+            if filename in self._queued:
+                return True
+
+            self._queued.add(filename)
+
+        try:
+            self.jobs.put(filename, block=block)
+        except queue.Full:
+            with self._lock:
+                self._queued.discard(filename)
+            return False
+
+        return True
+
+    def join(self):
+        '''Waits until all the files added to the queue so far are processed.'''
+        self.jobs.join()
+
+    def scan(self):
+        '''Checks the directory once and adds the files which are ready to the queue, returns the added files.'''
+        added = []
+        current = {}
+
+        entries = [entry for entry in os.scandir(self.directory) if entry.is_file() and not entry.name.startswith('.')]
+        inputs = {entry.path: output_files(entry.path) for entry in entries if output_files(entry.path) is not None}
+        generated = {output for outputs in inputs.values() for output in outputs}
+
+        for filename in sorted(inputs):
+            # Outputs of another file are never inputs, but a file named like an output without its input is
+            if filename in generated:
+                continue
+
+            stat = os.stat(filename)
+            current[filename] = (stat.st_size, stat.st_mtime_ns)
+
+            with self._lock:
+                if filename in self._queued:
+                    continue
+
+                # The file as it was when it was last read, which is also not tried again after failing until it changes
+                if filename in self.done:
+                    if self.done[filename][0] == current[filename]:
+                        continue
+                # Outputs from before the service started
+                elif all(os.path.isfile(output) and os.stat(output).st_mtime_ns >= stat.st_mtime_ns for output in inputs[filename]):
+                    continue
+
+            # Only files which did not change since the last check are complete
+            if self._seen.get(filename) != current[filename]:
+                continue
+
+            if not self.submit(filename, block=False):
+                continue
+
+            added.append(filename)
+
+        self._seen = current
+
+        # Forget the files which are not in the directory anymore, so a service running for a long time does not keep growing
+        directory = os.path.dirname(os.path.join(self.directory, ''))
+
+        with self._lock:
+            removed = [filename for filename in self.done if os.path.dirname(filename) == directory and filename not in current]
+
+            for filename in removed:
+                del self.done[filename]
+
+        return added
+
+    def _pool(self):
+        return parallel_backend('loky', idle_worker_timeout=idle_worker_timeout)
+
+    def _watch(self):
+        while not self._stop.is_set():
+            try:
+                self.scan()
+            except OSError as e:
+                logger.error(f'Could not check {self.directory}: {e}')
+
+            self._stop.wait(self.interval)
+
+    def _work(self):
+        # The backend is configured for each thread, with the same parameters as in start so the same pool is reused
+        with self._pool():
+            while not self._stop.is_set():
+                try:
+                    filename = self.jobs.get(timeout=self.interval)
+                except queue.Empty:
+                    continue
+
+                self._process(filename)
+                self.jobs.task_done()
+
+    def _process(self, filename):
+        start = time.perf_counter()
+        stat = None
+
+        # The size and modification time are taken before reading, so a file replaced while it is estimated is estimated again
+        try:
+            stat = os.stat(filename)
+            result = estimate_file(filename, **self.options)
+            logger.info(f'Estimated {filename} in {time.perf_counter() - start:.2f} s')
+        except Exception as e:
+            logger.error(f'Could not estimate {filename}: {e}')
+            result = e
+
+        with self._lock:
+            if stat is not None:
+                self.done[filename] = ((stat.st_size, stat.st_mtime_ns), result)
+
+            self._queued.discard(filename)
+
+
+def buildArgsParser():
+
+    p = argparse.ArgumentParser(description=DESCRIPTION,
+                                formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    p.add_argument('directory', metavar='directory',
+                   help='Directory to watch for new nifti files.')
+
+    p.add_argument('--noise_maps', action='store_true',
+                   help='The files contain noise maps, see autodmri_get_distribution.')
+
+    p.add_argument('-m', '--method', choices=['moments', 'maxlk'], default='moments',
+                   help='Method used to estimate the parameters.')
+
+    p.add_argument('-a', '--axis', metavar='int', type=int, default=-2,
+                   help='Axis along which to estimate the parameters when not using noise maps.')
+
+    p.add_argument('--size', metavar='int', type=int, default=5,
+                   help='Size of the window for local noise maps estimation.')
+
+    p.add_argument('--subsample', action='store_true',
+                   help='Use non-overlapping windows for noise maps.')
+
+    p.add_argument('--fast_median', action='store_true',
+                   help='Computes the median of the medians of each volume.')
+
+    p.add_argument('--ncores', metavar='int', type=int, default=-1,
+                   help='Number of cores to use for each file, -1 uses all of them.')
+
+    p.add_argument('--workers', metavar='int', type=int, default=2,
+                   help='Number of files processed at the same time.')
+
+    p.add_argument('--queue_size', metavar='int', type=int, default=8,
+                   help='Maximum number of files waiting to be processed.')
+
+    p.add_argument('--interval', metavar='float', type=float, default=1.,
+                   help='Time in seconds between two checks of the directory.')
+
+    p.add_argument('-v', '--verbose', action='store_true', dest='verbose',
+                   help='If set, prints each processed file.')
+
+    return p
+
+
+def main():
+    parser = buildArgsParser()
+    args = parser.parse_args()
+
+    handler = logging.StreamHandler()
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s', "%Y-%m-%d %H:%M:%S")
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+
+    if args.verbose:
+        logger.setLevel(logging.INFO)
+
+    if not os.path.isdir(args.directory):
+        parser.error(f'{args.directory} is not a directory!')
+
+    service = EstimationService(args.directory, nworkers=args.workers, queue_size=args.queue_size, interval=args.interval,
+                                noise_maps=args.noise_maps, method=args.method, axis=args.axis, size=args.size, full=not args.subsample,
+                                ncores=args.ncores, fast_median=args.fast_median)
+    service.start()
+
+    try:
+        while True:
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        logger.info('Stopping after the files currently being processed')
+        service.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+import numpy as np
+
+from autodmri.gamma import get_noise_distribution_from_sums
+from autodmri.estimator import _upsample, _grid_count
+
+
+class NoiseMapsAccumulator():
+    '''Accumulates statistics of noise maps in 3D windows, one volume at a time.
+
+    Only the running sums of m, m**2, m**4, log(m**2) and the number of nonzero values are kept for each window,
+    so that noise maps with many repetitions never need to be fully loaded in memory.
+    New repetitions can be added at any time and the estimation only uses the sums, without going over the data again.
+    This gives the same results as estimate_from_nmaps when use_rejection is False.
+
+    input
+    ------
+        shape : the 3D shape of the noise maps.
+
+    optional
+    --------
+        size : size of the 3D windows (default 5)
+
+        full : bool, if True estimates are made in overlapping windows
+    '''
+
+    def __init__(self, shape, size=5, full=False):
+        self.shape = tuple(shape[:3])
+        self.size = size
+        self.full = full
+
+        if full:
+            windows = tuple(max(n - size + 1, 0) for n in self.shape)
+        else:
+            windows = tuple(n // size for n in self.shape)
+
+        self.sum_m = np.zeros(windows, dtype=np.float64)
+        self.sum_m2 = np.zeros(windows, dtype=np.float64)
+        self.sum_m4 = np.zeros(windows, dtype=np.float64)
+        self.sum_log_m2 = np.zeros(windows, dtype=np.float64)
+        self.count = np.zeros(windows, dtype=np.int64)
+        self.nvolumes = 0
+
+    def update(self, data):
+        '''Adds a 3D volume, or each volume along the last axis of a 4D array, to the running sums.'''
+        data = np.asarray(data)
+
+        if data.ndim == 3:
+            data = data[..., None]
+
+        if data.shape[:3] != self.shape:
+            raise ValueError(f'Data of shape {data.shape[:3]} does not match the shape of the noise maps {self.shape}')
+
+        for idx in range(data.shape[-1]):
+            self._add(data[..., idx])
+
+    def _add(self, volume):
+        # Only the nonzero values are used, as in get_noise_distribution
+        nonzero = volume > 0
+        m = np.where(nonzero, volume, 0).astype(np.float64)
+        m2 = m**2
+        log_m2 = np.log(m2, out=np.zeros_like(m2), where=nonzero)
+
+        self.sum_m += self._window_sum(m)
+        self.sum_m2 += self._window_sum(m2)
+        self.sum_m4 += self._window_sum(m2**2)
+        self.sum_log_m2 += self._window_sum(log_m2)
+        self.count += self._window_sum(nonzero.astype(np.int64))
+        self.nvolumes += 1
+
+    def _window_sum(self, values):
+        if self.full:
+            return _box_sum(values, self.size)
+
+        x, y, z = np.array(self.count.shape) * self.size
+        values = values[:x, :y, :z].reshape(x // self.size, self.size, y // self.size, self.size, z // self.size, self.size)
+        return values.sum(axis=(1, 3, 5))
+
+    def estimate(self, method='moments', return_mask=False, return_count=False):
+        '''Estimates sigma and N at each voxel from the volumes added so far.
+
+        input
+        ------
+            method='moments' or method='maxlk' : which algorithm to use to estimate sigma and N
+
+            return_mask : bool, if True also returns the voxels which are part of at least one window
+
+            return_count : bool, if True also returns the number of windows used for the estimates at each voxel
+
+        output
+        -------
+        sigma, N, mask (optional), count (optional)
+        '''
+        sigma, N = get_noise_distribution_from_sums(self.sum_m, self.sum_m2, self.sum_m4, self.sum_log_m2, self.count, method=method)
+
+        invalid = np.logical_or(np.isnan(sigma), np.isnan(N))
+        sigma[invalid] = 0
+        N[invalid] = 0
+
+        # Average each voxel over all the windows it is part of or interpolate the non-overlapping windows
+        if self.full:
+            padding = [(self.size - 1, self.size - 1)] * 3
+            count = _box_sum(np.pad(np.ones(sigma.shape), padding), self.size)
+            mask = count > 0
+
+            sigma_sum = _box_sum(np.pad(sigma, padding), self.size)
+            N_sum = _box_sum(np.pad(N, padding), self.size)
+
+            sigma = np.zeros(self.shape, dtype=np.float32)
+            N = np.zeros(self.shape, dtype=np.float32)
+            sigma[mask] = sigma_sum[mask] / count[mask]
+            N[mask] = N_sum[mask] / count[mask]
+            count = count.astype(np.min_scalar_type(self.size**3))
+        else:
+            sigma, N = _upsample((sigma, N), self.size, self.shape)
+            count = _grid_count(self.count.shape, self.size, self.shape)
+            mask = count > 0
+
+        output = [sigma, N]
+
+        if return_mask:
+            output.append(mask)
+
+        if return_count:
+            output.append(count)
+
+        return tuple(output)
+
+
+def _box_sum(values, size):
+    '''Sums values in every window of the given size, one axis at a time.'''
+    for axis in range(values.ndim):
+        if values.shape[axis] < size:
+            shape = list(values.shape)
+            shape[axis] = 0
+            return np.zeros(shape, dtype=values.dtype)
+
+        padding = [(0, 0)] * values.ndim
+        padding[axis] = (1, 0)
+        cumsum = np.pad(values, padding).cumsum(axis=axis)
+
+        upper = [slice(None)] * values.ndim
+        lower = [slice(None)] * values.ndim
+        upper[axis] = slice(size, None)
+        lower[axis] = slice(None, -size)
+        values = cumsum[tuple(upper)] - cumsum[tuple(lower)]
+
+    return values
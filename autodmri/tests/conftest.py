@@ -0,0 +1,60 @@
+import time
+import pytest
+import numpy as np
+
+# (test, time of the reference, time of the fast path) for each comparison made with the timed fixture
+timings = []
+
+
+def _best_time(func, repeat):
+    best = float('inf')
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = func()
+        best = min(best, time.perf_counter() - start)
+
+    return output, best
+
+
+def noncentral_chi(shape, sigma, N, signal=0, seed=0):
+    '''Synthetic noise maps of the given shape, the magnitude of 2N gaussians of standard deviation sigma in each value.
+
+    sigma and signal are either a number or one value per voxel, that is over shape[:-1], and signal is added to the first gaussian.
+    '''
+    rng = np.random.default_rng(seed)
+    sigma = np.broadcast_to(sigma, shape[:-1])[..., None, None]
+    gaussians = rng.normal(0, 1, size=tuple(shape) + (2 * N,)) * sigma
+    gaussians[..., 0] += np.broadcast_to(signal, shape[:-1])[..., None]
+
+    return np.sqrt(np.sum(gaussians**2, axis=-1))
+
+
+@pytest.fixture
+def make_noise_maps():
+    '''The generator of synthetic data used by all the tests, see noncentral_chi.'''
+    return noncentral_chi
+
+
+@pytest.fixture
+def timed(request):
+    '''Runs a reference and a fast function, records how long each took and returns both outputs.'''
+    def run(reference, fast, repeat=1):
+        expected, reference_time = _best_time(reference, repeat)
+        output, fast_time = _best_time(fast, repeat)
+
+        timings.append((request.node.nodeid, reference_time, fast_time))
+        request.node.user_properties.append(('speedup', reference_time / fast_time))
+
+        return expected, output
+    return run
+
+
+def pytest_terminal_summary(terminalreporter):
+    if not timings:
+        return
+
+    terminalreporter.write_sep('-', 'speedup of the fast paths over the reference implementation')
+
+    for nodeid, reference_time, fast_time in timings:
+        terminalreporter.write_line(f'{reference_time / fast_time:7.1f}x {1000 * reference_time:9.1f} ms -> {1000 * fast_time:8.1f} ms  {nodeid}')
@@ -0,0 +1,319 @@
+import os
+import pytest
+import numpy as np
+
+from autodmri import estimator
+from autodmri.estimator import estimate_from_dwis, estimate_from_nmaps, _upsample, _volume_medians, _get_median
+from autodmri.incremental import IncrementalEstimator
+from autodmri.streaming import NoiseMapsAccumulator
+from autodmri.result import NoiseDistribution
+from autodmri.estimator import _noise_mask, _lambda_cdf, _relative_gradient
+
+
+@pytest.fixture
+def make_dwis(make_noise_maps):
+    '''Noise everywhere and some signal in the middle.'''
+    def make(shape, sigma, N, seed=0):
+        signal = np.zeros(shape[:-1])
+        signal[shape[0]//4:-shape[0]//4, shape[1]//4:-shape[1]//4] = 20 * sigma
+        return make_noise_maps(shape, sigma, N, signal=signal, seed=seed)
+    return make
+
+
+def test_pyramid(make_noise_maps):
+    # Uniform noise in one half and a step in the other half
+    sigma = np.full((20, 20, 10), 10.)
+    sigma[10:] = 30.
+    data = make_noise_maps((20, 20, 10, 4), sigma, N=2)
+
+    sigma_full, N_full, _ = estimate_from_nmaps(data, size=5, full=True, ncores=1)
+    sigma_pyr, N_pyr, mask = estimate_from_nmaps(data, size=5, pyramid=True, coarse_size=5, threshold=0.1, ncores=1)
+
+    # The step is refined, which is the same as estimating everywhere near it
+    np.testing.assert_allclose(sigma_pyr[8:12], sigma_full[8:12], rtol=1e-5)
+    np.testing.assert_allclose(N_pyr[8:12], N_full[8:12], rtol=1e-5)
+    np.testing.assert_allclose(sigma_pyr[:5], 10, rtol=0.2)
+    np.testing.assert_allclose(sigma_pyr[15:], 30, rtol=0.2)
+    assert mask.all()
+
+    # Refining everywhere falls back to the overlapping windows
+    sigma_pyr, N_pyr = estimate_from_nmaps(data, size=5, pyramid=True, threshold=0, return_mask=False, ncores=1)
+    np.testing.assert_allclose(sigma_pyr, sigma_full, rtol=1e-5)
+    np.testing.assert_allclose(N_pyr, N_full, rtol=1e-5)
+
+
+def test_relative_gradient():
+    # A step just above the threshold is flagged on both sides, a step just below it is not
+    grid = np.full((4, 3, 3), 10.)
+    grid[2:] = 11.5
+
+    flagged = _relative_gradient(grid) > 0.1
+    assert flagged[1:3].all()
+    assert not flagged[[0, 3]].any()
+
+    grid[2:] = 10.5
+    assert not (_relative_gradient(grid) > 0.1).any()
+
+    # Empty values are only flagged next to non empty ones
+    grid = np.zeros((4, 1, 1))
+    grid[0] = 10.
+    np.testing.assert_equal(_relative_gradient(grid).ravel(), [1, np.inf, 0, 0])
+
+
+def test_upsample():
+    # A ramp is exact between the window centers and constant past them
+    grid = np.arange(4, dtype=np.float32)[:, None, None] * np.ones((4, 3, 2))
+    sigma, N = _upsample((grid, 2 * grid), 5, (23, 16, 11))
+
+    expected = np.clip((np.arange(23) - 2) / 5, 0, 3)
+    np.testing.assert_allclose(sigma, np.broadcast_to(expected[:, None, None], sigma.shape), atol=1e-6)
+    np.testing.assert_allclose(N, 2 * sigma)
+
+
+def test_noise_mask():
+    # Sums of squares of noise voxels with a varying number of nonzero values K, as masked data has
+    rng = np.random.default_rng(0)
+    K = rng.integers(0, 20, size=(15, 12))
+    sum_data2 = 2 * 5**2 * rng.gamma(2 * K + 1e-3)
+    phi = np.linspace(1, 10, 20)
+
+    for N_min, N_max in [(1, 12), (2.5, 2.5)]:
+        # The bounds computed for every voxel, as before
+        lambda_minus = _lambda_cdf(N_min*K, 0.05/2)
+        lambda_plus = _lambda_cdf(N_max*K, 1 - 0.05/2)
+        expected = np.zeros(K.shape, dtype=bool)
+
+        for sigma in phi:
+            s = sum_data2 / (2*sigma**2)
+            current = np.logical_and(lambda_minus < s, s < lambda_plus)
+
+            if current.sum() > expected.sum():
+                expected = current
+
+        assert expected.any()
+        assert np.array_equal(_noise_mask(sum_data2, K, N_min, N_max, phi), expected)
+
+
+def test_subsample_border(make_noise_maps):
+    data = make_noise_maps((12, 11, 7, 4), 10., N=1)
+    sigma, N, mask = estimate_from_nmaps(data, size=5, full=False, ncores=1)
+
+    # The cropped border is filled, but no noise voxel is in there
+    assert sigma.shape == data.shape[:-1]
+    assert np.all(sigma > 0) and np.all(N > 0)
+    assert mask[:10, :10, :5].all()
+    assert not mask[10:].any()
+
+
+def test_accumulator(make_noise_maps):
+    data = make_noise_maps((12, 11, 7, 6), 10., N=2)
+
+    for full in [True, False]:
+        for method in ['moments', 'maxlk']:
+            sigma, N = estimate_from_nmaps(data, size=5, full=full, method=method, return_mask=False, ncores=1)
+
+            # Add volumes in two goes, as if new repetitions were acquired later on
+            accumulator = NoiseMapsAccumulator(data.shape, size=5, full=full)
+            accumulator.update(data[..., :4])
+            accumulator.update(data[..., 4:])
+            sigma_stream, N_stream = accumulator.estimate(method=method)
+
+            assert accumulator.nvolumes == data.shape[-1]
+            np.testing.assert_allclose(sigma_stream, sigma, rtol=1e-4)
+            np.testing.assert_allclose(N_stream, N, rtol=1e-4)
+
+
+def test_result(make_noise_maps):
+    sigma = np.linspace(5, 20, 17)[:, None, None] * np.ones((17, 13, 12))
+    data = make_noise_maps((17, 13, 12, 4), sigma, N=2)
+    everywhere = np.nonzero(np.ones(data.shape[:-1], dtype=bool))
+
+    sigma, N, mask = estimate_from_nmaps(data, size=5, full=False, ncores=1)
+    result = NoiseDistribution.from_nmaps(data, size=5, full=False, ncores=1)
+
+    assert result.layout == 'grid'
+    assert np.array_equal(result.mask, mask)
+    np.testing.assert_allclose(result.sigma_map(), sigma)
+    np.testing.assert_allclose(result.N_map(), N)
+    np.testing.assert_allclose(result.sigma_at(everywhere), sigma[everywhere], rtol=1e-5)
+    np.testing.assert_allclose(result.N_at(everywhere), N[everywhere], rtol=1e-5)
+
+    # Slabs are only broadcasted
+    result = NoiseDistribution.from_dwis(data, axis=0, ncores=1)
+    sigma_map = result.sigma_map()
+
+    assert sigma_map.shape == data.shape[:-1]
+    assert not sigma_map.flags.writeable
+    np.testing.assert_allclose(sigma_map[everywhere], result.sigma_at(everywhere))
+    np.testing.assert_allclose(result.N_at(everywhere), result.N[everywhere[0]])
+
+    # Options of overlapping windows are not silently ignored
+    with pytest.raises(TypeError):
+        NoiseDistribution.from_nmaps(data, size=5, full=False, checkpoint='checkpoint.npz', ncores=1)
+
+    with pytest.raises(TypeError):
+        NoiseDistribution.from_nmaps(data, size=5, full=True, return_count=True, ncores=1)
+
+    for kwargs in [{'return_mask': True}, {'return_diagnostics': True}]:
+        with pytest.raises(TypeError):
+            NoiseDistribution.from_dwis(data, axis=0, ncores=1, **kwargs)
+
+    with pytest.raises(ValueError):
+        NoiseDistribution.from_dwis(data, axis='all', ncores=1)
+
+
+def test_incremental(make_dwis):
+    data = make_dwis((20, 20, 6, 10), 10., N=2)
+
+    for method in ['moments', 'maxlk']:
+        sigma, N, mask = estimate_from_dwis(data, axis=2, method=method, return_mask=True, ncores=1)
+
+        estimator = IncrementalEstimator(data, axis=2, method=method, ncores=1)
+        sigma_inc, N_inc, mask_inc = estimator.estimate(return_mask=True)
+
+        np.testing.assert_allclose(sigma_inc, sigma, rtol=1e-5)
+        np.testing.assert_allclose(N_inc, N, rtol=1e-5)
+        assert np.array_equal(mask_inc, mask)
+
+        # Only the slab with excluded voxels changes
+        exclude_mask = np.zeros(data.shape[:-1], dtype=bool)
+        exclude_mask[:5, :5, 3] = True
+
+        sigma, N, mask = estimate_from_dwis(data, axis=2, method=method, return_mask=True, exclude_mask=exclude_mask, ncores=1)
+        sigma_warm, N_warm = estimator.estimate(exclude_mask)
+
+        estimator = IncrementalEstimator(data, axis=2, method=method, ncores=1)
+        estimator.estimate()
+        sigma_inc, N_inc, mask_inc = estimator.estimate(exclude_mask, return_mask=True, warm_start=False)
+
+        np.testing.assert_allclose(sigma_inc, sigma, rtol=1e-5)
+        np.testing.assert_allclose(N_inc, N, rtol=1e-5)
+        np.testing.assert_allclose(sigma_warm, sigma, rtol=1e-2)
+        assert np.array_equal(mask_inc, mask)
+        assert not mask_inc[:5, :5, 3].any()
+
+
+def test_all_axes(make_dwis):
+    data = make_dwis((20, 16, 6, 10), 10., N=2)
+    sigma, N, scores, mask = estimate_from_dwis(data, axis='all', return_mask=True, ncores=1)
+
+    assert len(sigma) == len(N) == len(scores) == len(mask) == 3
+
+    for axis in range(3):
+        sigma_axis, N_axis, mask_axis = estimate_from_dwis(data, axis=axis, return_mask=True, ncores=1)
+
+        np.testing.assert_allclose(sigma[axis], sigma_axis, rtol=1e-5)
+        np.testing.assert_allclose(N[axis], N_axis, rtol=1e-5)
+        assert np.array_equal(mask[axis], mask_axis)
+        assert 0 < scores[axis] <= 1
+
+
+def test_volume_medians(make_dwis):
+    data = make_dwis((10, 9, 8, 20), 10., N=1)
+    data[:7, ..., 5] = 0
+    data[:2, ..., 6] = -1
+
+    medians = _volume_medians(data)
+
+    assert np.median(data[..., 5]) == 0
+    assert medians[5] == np.median(data[..., 5][data[..., 5] > 0])
+    assert medians[6] == np.median(data[..., 6])
+    assert np.median(medians) == _get_median(data, fast_median=True)
+
+
+def test_diagnostics(make_dwis):
+    data = make_dwis((20, 16, 6, 10), 10., N=2)
+    sigma, N, mask, diagnostics = estimate_from_dwis(data, axis=2, return_mask=True, return_diagnostics=True, ncores=1)
+
+    assert diagnostics.shape == (data.shape[2],)
+    assert np.array_equal(diagnostics['mask_size'], mask.sum(axis=(0, 1)))
+    assert np.all(diagnostics['iterations'][diagnostics['converged']] < 100)
+    assert np.all(diagnostics['time'] >= 0)
+
+    # Stopping early does not converge
+    _, _, diagnostics = estimate_from_dwis(data, axis=2, max_iter=1, eps=0, return_diagnostics=True, ncores=1)
+    assert np.all(diagnostics['iterations'] <= 1)
+    assert not diagnostics['converged'].any()
+
+    with pytest.raises(ValueError):
+        estimate_from_dwis(data, axis=2, max_iter=0, ncores=1)
+
+
+def test_count(make_noise_maps):
+    data = make_noise_maps((12, 11, 10, 4), 10., N=1)
+
+    sigma, N, mask, count = estimate_from_nmaps(data, size=5, full=True, return_count=True, ncores=1)
+    assert count.dtype == np.uint8 and mask.dtype == bool
+    assert count.max() == 125 and count.min() == 1
+    assert mask.all()
+
+    # Each voxel is in as many windows as there are starts along each axis which contain it
+    starts = [np.minimum(np.arange(n), n - 5) - np.maximum(np.arange(n) - 4, 0) + 1 for n in data.shape[:-1]]
+    assert np.array_equal(count, np.einsum('i,j,k->ijk', *starts))
+
+    _, _, mask, count = estimate_from_nmaps(data, size=5, full=False, return_count=True, ncores=1)
+    assert np.array_equal(count > 0, mask)
+
+    accumulator = NoiseMapsAccumulator(data.shape, size=5, full=True)
+    accumulator.update(data)
+    _, _, count_stream = accumulator.estimate(return_count=True)
+    assert np.array_equal(count_stream, estimate_from_nmaps(data, size=5, full=True, return_count=True, ncores=1)[-1])
+
+    _, _, mask, count = estimate_from_nmaps(data, size=7, full=True, return_count=True, ncores=1)
+    assert count.dtype == np.uint16
+
+
+def test_checkpoint(tmp_path, monkeypatch, make_noise_maps):
+    data = make_noise_maps((9, 8, 7, 4), 10., N=2)
+    checkpoint = str(tmp_path / 'checkpoint.npz')
+    sigma, N, mask = estimate_from_nmaps(data, size=3, full=True, ncores=1)
+
+    # Stop after a few blocks, as if the job was preempted
+    calls = []
+    proc_inner = estimator.proc_inner
+
+    def preempted(*args):
+        if len(calls) == 100:
+            raise KeyboardInterrupt
+        calls.append(1)
+        return proc_inner(*args)
+
+    monkeypatch.setattr(estimator, 'proc_inner', preempted)
+
+    with pytest.raises(KeyboardInterrupt):
+        estimate_from_nmaps(data, size=3, full=True, ncores=1, checkpoint=checkpoint, checkpoint_every=40)
+
+    # Only the 80 windows of the completed blocks are skipped
+    calls.clear()
+    monkeypatch.setattr(estimator, 'proc_inner', lambda *args: calls.append(1) or proc_inner(*args))
+    sigma_resumed, N_resumed, mask_resumed = estimate_from_nmaps(data, size=3, full=True, ncores=1, checkpoint=checkpoint, resume=True,
+                                                                 checkpoint_every=40)
+
+    assert len(calls) == 7 * 6 * 5 - 80
+    assert not os.path.isfile(checkpoint)
+    np.testing.assert_allclose(sigma_resumed, sigma, rtol=1e-6)
+    np.testing.assert_allclose(N_resumed, N, rtol=1e-6)
+    assert np.array_equal(mask_resumed, mask)
+
+    # A checkpoint from other options is not used
+    calls.clear()
+    monkeypatch.setattr(estimator, 'proc_inner', preempted)
+
+    with pytest.raises(KeyboardInterrupt):
+        estimate_from_nmaps(data, size=3, full=True, ncores=1, checkpoint=checkpoint, checkpoint_every=40)
+
+    with pytest.raises(ValueError):
+        estimate_from_nmaps(data, size=3, full=True, ncores=1, checkpoint=checkpoint, resume=True, checkpoint_every=20)
+
+    # Nor one from other noise maps of the same shape, or with another median when rejecting voxels
+    with pytest.raises(ValueError):
+        estimate_from_nmaps(data + 1, size=3, full=True, ncores=1, checkpoint=checkpoint, resume=True, checkpoint_every=40)
+
+    with pytest.raises(ValueError):
+        estimate_from_nmaps(data, size=3, full=True, ncores=1, checkpoint=checkpoint, resume=True, checkpoint_every=40,
+                            use_rejection=True)
+
+    # Only overlapping windows are checkpointed
+    for options in [{'full': False}, {'pyramid': True}]:
+        with pytest.raises(ValueError):
+            estimate_from_nmaps(data, size=3, ncores=1, checkpoint=checkpoint, **options)
@@ -0,0 +1,170 @@
+import numpy as np
+import pytest
+
+from itertools import product
+from scipy.special import gammaincinv
+
+from autodmri.gamma import get_noise_distribution, get_noise_distribution_from_sums
+from autodmri.estimator import estimate_from_nmaps, _inner, _inner_from_stats, _voxel_statistics, _get_median
+from autodmri.streaming import NoiseMapsAccumulator
+
+# Each fast path is compared with the reference implementation it replaces on synthetic noncentral chi data,
+# with the timings of both reported at the end of the test session.
+# Cases are (N, number of volumes K, how zeros are put in the data, seed)
+cases = list(product([1, 4, 12], [5, 40], ['none', 'random', 'masked'], [0]))
+ids = [f'N{N}-K{K}-{zeros}' for N, K, zeros, _ in cases]
+
+
+@pytest.fixture
+def make_noncentral_chi(make_noise_maps):
+    '''Noise maps of known sigma and N with some signal in the middle of the first axis.
+
+    zeros is either none, random for random zero values or masked for a block of voxels which are zero in every volume.
+    '''
+    def make(shape, sigma, N, zeros='none', seed=0):
+        signal = np.zeros(shape[:-1])
+        signal[shape[0]//3:-shape[0]//3] = 10 * sigma
+        data = make_noise_maps(shape, sigma, N, signal=signal, seed=seed)
+
+        if zeros == 'random':
+            data[np.random.default_rng(seed).random(shape) < 0.05] = 0
+        elif zeros == 'masked':
+            data[:, :shape[1]//4] = 0
+
+        return data
+    return make
+
+
+def sums_of(windows):
+    '''The sums needed by get_noise_distribution_from_sums over the positive values of each row.'''
+    positive = windows > 0
+    m = np.where(positive, windows, 0).astype(np.float64)
+    log_m2 = np.log(m**2, out=np.zeros_like(m), where=positive)
+
+    return m.sum(axis=-1), (m**2).sum(axis=-1), (m**4).sum(axis=-1), log_m2.sum(axis=-1), positive.sum(axis=-1)
+
+
+@pytest.mark.parametrize('method', ['moments', 'maxlk'])
+@pytest.mark.parametrize('N, K, zeros, seed', cases, ids=ids)
+def test_noise_distribution_from_sums(timed, make_noncentral_chi, N, K, zeros, seed, method):
+    windows = make_noncentral_chi((200, K), 5., N, zeros, seed)
+
+    # A constant and an empty row are the edge cases
+    windows[0] = 3
+    windows[1] = 0
+
+    expected, output = timed(lambda: np.array([get_noise_distribution(window, method=method) for window in windows]).T,
+                             lambda: get_noise_distribution_from_sums(*sums_of(windows), method=method))
+
+    np.testing.assert_allclose(output, expected, rtol=1e-5, atol=1e-8)
+
+
+def reference_inner(data, median, exclude_mask=None, method='moments', l=50, N_min=1, N_max=12, max_iter=100, eps=1e-3):
+    '''Frozen copy of _inner as it was before any optimization, the reference for both _inner and _inner_from_stats.'''
+
+    def lambda_cdf(N, alpha_prob):
+        out = gammaincinv(N, alpha_prob)
+        out = np.nan_to_num(out).clip(min=1e-7)
+        return out
+
+    def get_mask(data, N_min, N_max, phi, alpha_prob=0.05):
+        data[data == 0] = np.nan
+        sum_data2 = np.nansum(data**2, axis=-1)
+        K = np.sum(np.isfinite(data), axis=-1)
+        data[np.isnan(data)] = 0
+
+        lambda_minus = lambda_cdf(N_min*K, alpha_prob/2)
+        lambda_plus = lambda_cdf(N_max*K, 1 - alpha_prob/2)
+
+        mask_current = np.zeros(data.shape[:-1], dtype=bool)
+        mask_loop = np.zeros(data.shape[:-1], dtype=bool)
+
+        for sigma in phi:
+            s = sum_data2 / (2*sigma**2)
+            mask_current[:] = np.logical_and(lambda_minus < s, s < lambda_plus)
+
+            if mask_current.sum() > mask_loop.sum():
+                mask_loop[:] = mask_current
+
+        return mask_loop
+
+    if exclude_mask is None:
+        exclude_mask = np.zeros(data.shape[:-1], dtype=bool)
+
+    data = data.astype(np.float64)
+    sigma_prev = -1
+    N_prev = -1
+    sigma_init = median / np.sqrt(2 * lambda_cdf(N_max, 0.5))
+    phi = np.arange(1, l+1) * sigma_init / l
+
+    for _ in range(max_iter):
+
+        mask = get_mask(data, N_min, N_max, phi)
+        mask *= np.logical_not(exclude_mask)
+
+        if mask.sum() == 0:
+            return 0, 0, np.zeros_like(mask)
+
+        datam = data[np.broadcast_to(mask[..., None], data.shape)]
+        sigma, N = get_noise_distribution(datam, method=method)
+
+        if sigma == 0 or N == 0:
+            return 0, 0, np.zeros_like(mask)
+
+        if (np.abs(N - N_prev) < eps) and (np.abs(sigma - sigma_prev) < eps):
+            break
+
+        if ((np.abs(N - N_prev) / N) < eps) and ((np.abs(sigma - sigma_prev) / sigma) < eps):
+            break
+
+        N_prev = N
+        sigma_prev = sigma
+
+        N_min = N
+        N_max = N
+
+        phi = np.linspace(.95, 1.05, num=11) * sigma
+
+    return sigma, N, mask
+
+
+engines = {'inner': lambda data, median, exclude_mask, method: _inner(data, median, exclude_mask, method=method),
+           'from_stats': lambda data, median, exclude_mask, method: _inner_from_stats(_voxel_statistics(data), median, exclude_mask,
+                                                                                      method=method)}
+
+
+@pytest.mark.parametrize('engine', list(engines))
+@pytest.mark.parametrize('method', ['moments', 'maxlk'])
+@pytest.mark.parametrize('N, K, zeros, seed', cases, ids=ids)
+def test_inner(timed, make_noncentral_chi, N, K, zeros, seed, method, engine):
+    data = make_noncentral_chi((30, 24, 1, K), 10., N, zeros, seed)
+    median = _get_median(data)
+
+    exclude_mask = np.zeros(data.shape[:-1], dtype=bool)
+    exclude_mask[-3:] = True
+
+    expected, output = timed(lambda: reference_inner(data, median, exclude_mask, method=method),
+                             lambda: engines[engine](data, median, exclude_mask, method))
+
+    np.testing.assert_allclose(output[:2], expected[:2], rtol=1e-5)
+    assert np.array_equal(output[2], expected[2])
+
+    if zeros != 'masked':
+        np.testing.assert_allclose(output[0], 10, rtol=0.2)
+
+
+@pytest.mark.parametrize('full', [False, True])
+@pytest.mark.parametrize('method', ['moments', 'maxlk'])
+@pytest.mark.parametrize('N, K, zeros, seed', cases[::2], ids=ids[::2])
+def test_accumulator(timed, make_noncentral_chi, N, K, zeros, seed, method, full):
+    data = make_noncentral_chi((14, 12, 8, K), 10., N, zeros, seed)
+
+    def accumulate():
+        accumulator = NoiseMapsAccumulator(data.shape, size=4, full=full)
+        accumulator.update(data)
+        return accumulator.estimate(method=method)
+
+    expected, output = timed(lambda: estimate_from_nmaps(data, size=4, full=full, method=method, return_mask=False, ncores=1),
+                             accumulate)
+
+    np.testing.assert_allclose(output, expected, rtol=1e-4, atol=1e-5)
@@ -1,5 +1,7 @@
 import subprocess
 import pytest
+import numpy as np
+import nibabel as nib
 
 from pathlib import Path
 
@@ -7,7 +9,13 @@ cwd = Path(__file__).parents[2] / Path("datasets")
 commands = ['autodmri_get_distribution data_SENSE3_MB3_noisemap.nii.gz sigma_maxlk_nmaps.nii.gz N_maxlk_nmaps.nii.gz mask_maxlk_nmaps.nii.gz -m maxlk --noise_maps',
             'autodmri_get_distribution data_SENSE3_MB3_noisemap.nii.gz sigma_nmaps.nii.gz N_nmaps.nii.gz mask_nmaps.nii.gz --noise_maps',
             'autodmri_get_distribution data_SENSE3_MB3_noisemap.nii.gz sigma_nmaps.nii.gz N_nmaps.nii.gz mask_nmaps.nii.gz --noise_maps -f --subsample',
+            'autodmri_get_distribution data_SENSE3_MB3_noisemap.nii.gz sigma_nmaps.nii.gz N_nmaps.nii.gz mask_nmaps.nii.gz --noise_maps -f --checkpoint checkpoint.npz --resume --checkpoint_every 5000',
+            'autodmri_get_distribution data_SENSE3_MB3_noisemap.nii.gz sigma_nmaps.nii.gz N_nmaps.nii.gz mask_nmaps.nii.gz --noise_maps -f --count count_nmaps.nii.gz --packed_mask mask_nmaps.npz',
             'autodmri_get_distribution data_SENSE3_MB3_noisemap.nii.gz sigma_nmaps.nii.gz N_nmaps.nii.gz mask_nmaps.nii.gz --noise_maps -f --fast_median -m maxlk',
+            'autodmri_get_distribution data_SENSE3_MB3_noisemap.nii.gz sigma_nmaps.nii.gz N_nmaps.nii.gz mask_nmaps.nii.gz --noise_maps -f --pyramid --threshold 0.2',
+            'autodmri_get_distribution data_SENSE3_MB3_noisemap.nii.gz sigma_nmaps.nii.gz N_nmaps.nii.gz mask_nmaps.nii.gz --noise_maps -f --stream -m maxlk',
+            'autodmri_get_distribution data_SENSE3_MB3_noisemap.nii.gz sigma.nii.gz N.nii.gz mask.nii.gz -f --axis all -v',
+            'autodmri_get_distribution data_SENSE3_MB3_noisemap.nii.gz sigma_diag.nii.gz N_diag.nii.gz mask_diag.nii.gz -f --max_iter 20 --eps 1e-4 --diagnostics diagnostics.csv',
             'autodmri_get_distribution dwi_1_8.nii.gz sigma.nii.gz N.nii.gz mask.nii.gz -v',
             'autodmri_get_distribution dwi_1_8.nii.gz sigma.nii.gz N.nii.gz mask.nii.gz -m maxlk -f --ncores 4',
             'autodmri_get_distribution dwi_1_8.nii.gz sigma_maxlk.nii.gz N_maxlk.nii.gz mask_maxlk.nii.gz -m maxlk --size 3 -f -v --axis 0']
@@ -15,3 +23,34 @@ commands = ['autodmri_get_distribution data_SENSE3_MB3_noisemap.nii.gz sigma_max
 @pytest.mark.parametrize('command', commands)
 def test_script(command):
     subprocess.run([command], shell=True, cwd=cwd, check=True)
+
+
+def test_stream_gzip(tmp_path, make_noise_maps):
+    data = make_noise_maps((12, 11, 10, 40), 10., N=1).astype(np.float32)
+    nib.Nifti1Image(data, np.eye(4)).to_filename(tmp_path / 'maps.nii.gz')
+
+    for name, option in [('stream', '--stream'), ('loaded', '')]:
+        command = f'autodmri_get_distribution maps.nii.gz sigma_{name}.nii.gz N_{name}.nii.gz mask_{name}.nii.gz --noise_maps --ncores 1 {option}'
+        subprocess.run([command], shell=True, cwd=tmp_path, check=True)
+
+    for output in ['sigma', 'N']:
+        streamed = nib.load(tmp_path / f'{output}_stream.nii.gz').get_fdata()
+        loaded = nib.load(tmp_path / f'{output}_loaded.nii.gz').get_fdata()
+        np.testing.assert_allclose(streamed, loaded, rtol=1e-4)
+
+
+def test_packed_mask_extension(tmp_path, make_noise_maps):
+    data = make_noise_maps((10, 10, 5, 3), 10., N=1).astype(np.float32)
+    nib.Nifti1Image(data, np.eye(4)).to_filename(tmp_path / 'maps.nii.gz')
+
+    command = 'autodmri_get_distribution maps.nii.gz sigma.nii.gz N.nii.gz mask.nii.gz --noise_maps --subsample --ncores 1 --packed_mask packed'
+    subprocess.run([command], shell=True, cwd=tmp_path, check=True)
+
+    with np.load(tmp_path / 'packed.npz') as f:
+        mask = np.unpackbits(f['mask'], count=np.prod(f['shape'])).reshape(f['shape'])
+    assert np.array_equal(mask, nib.load(tmp_path / 'mask.nii.gz').get_fdata())
+
+    # The written file is also the one checked before overwriting
+    (tmp_path / 'sigma.nii.gz').unlink()
+    with pytest.raises(subprocess.CalledProcessError):
+        subprocess.run([command], shell=True, cwd=tmp_path, check=True)
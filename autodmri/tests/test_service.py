@@ -0,0 +1,123 @@
+import os
+import time
+import pytest
+import numpy as np
+import nibabel as nib
+
+from autodmri.estimator import estimate_from_nmaps
+from autodmri.service import EstimationService, output_files
+
+
+@pytest.fixture
+def make_file(make_noise_maps):
+    '''Writes small noise maps to filename and returns them.'''
+    def make(filename, seed, sigma=10):
+        data = make_noise_maps((10, 10, 5, 3), sigma, N=1, seed=seed).astype(np.float32)
+        nib.Nifti1Image(data, np.eye(4)).to_filename(filename)
+        return data
+    return make
+
+
+def test_scan(tmp_path, make_file):
+    for idx in range(2):
+        make_file(tmp_path / f'maps{idx}.nii.gz', idx)
+
+    (tmp_path / 'notes.txt').write_text('not a nifti file')
+    service = EstimationService(str(tmp_path), queue_size=1, noise_maps=True, ncores=1)
+
+    # Files are only taken once they did not change between two checks and the queue is bounded
+    assert service.scan() == []
+    assert service.scan() == [str(tmp_path / 'maps0.nii.gz')]
+    assert service.scan() == []
+    assert service.jobs.qsize() == 1
+
+
+def wait_for(condition, timeout=60):
+    timeout = time.perf_counter() + timeout
+
+    while not condition() and time.perf_counter() < timeout:
+        time.sleep(0.01)
+
+
+@pytest.mark.parametrize('ncores', [1, 2])
+def test_service(tmp_path, ncores, make_file):
+    data = [make_file(tmp_path / f'maps{idx}.nii', idx) for idx in range(3)]
+    inputs = [str(tmp_path / f'maps{idx}.nii') for idx in range(3)]
+
+    # Two workers estimate at the same time, each with the same pool of processes when ncores > 1
+    service = EstimationService(str(tmp_path), nworkers=2, queue_size=1, interval=0.01, noise_maps=True, full=False, ncores=ncores)
+    service.start()
+
+    try:
+        wait_for(lambda: len(service.done) == len(inputs))
+        assert sorted(service.done) == inputs
+
+        for filename, maps in zip(inputs, data):
+            assert service.done[filename][1] == output_files(filename)
+            sigma, N, mask = estimate_from_nmaps(maps, full=False, ncores=1)
+
+            for expected, output in zip((sigma, N, mask), service.done[filename][1]):
+                np.testing.assert_allclose(nib.load(output).get_fdata(), expected, rtol=1e-6)
+
+        # The outputs are not processed again, but a replaced input is
+        assert service.scan() == []
+
+        sigma_file = output_files(inputs[0])[0]
+        modified = os.stat(sigma_file).st_mtime_ns
+        make_file(inputs[0], 0, sigma=50)
+
+        wait_for(lambda: os.stat(sigma_file).st_mtime_ns > modified)
+        np.testing.assert_allclose(nib.load(sigma_file).get_fdata().mean(), 50, rtol=0.1)
+    finally:
+        service.stop()
+
+
+def test_failed(tmp_path, make_file):
+    filename = str(tmp_path / 'broken.nii')
+    (tmp_path / 'broken.nii').write_text('not a nifti file')
+
+    service = EstimationService(str(tmp_path), noise_maps=True, ncores=1)
+    service.scan()
+    assert service.scan() == [filename]
+
+    service._process(service.jobs.get())
+    assert isinstance(service.done[filename][1], Exception)
+
+    # Tried again only once the file changes, and forgotten once it is removed
+    assert service.scan() == []
+    make_file(filename, 0)
+    service.scan()
+    assert service.scan() == [filename]
+
+    os.remove(filename)
+    service.scan()
+    assert filename not in service.done
+
+
+def test_replaced_while_estimating(tmp_path, make_file):
+    filename = str(tmp_path / 'maps.nii')
+    make_file(filename, 0)
+
+    service = EstimationService(str(tmp_path), noise_maps=True, full=False, ncores=1)
+    service.scan()
+    service.scan()
+    service._process(service.jobs.get())
+
+    # Replaced before the outputs were written, so the outputs look more recent than the new file
+    make_file(filename, 1, sigma=50)
+    outputs_time = os.stat(output_files(filename)[0]).st_mtime_ns
+    os.utime(filename, ns=(outputs_time - 10**6, outputs_time - 10**6))
+
+    service.scan()
+    assert service.scan() == [filename]
+
+
+def test_named_like_outputs(tmp_path, make_file):
+    # Without a run.nii file, run_N.nii is an input of its own
+    make_file(tmp_path / 'run_N.nii', 0)
+    make_file(tmp_path / 'maps.nii', 1)
+    make_file(tmp_path / 'maps_N.nii', 2)
+
+    service = EstimationService(str(tmp_path), noise_maps=True, ncores=1)
+    service.scan()
+    assert service.scan() == [str(tmp_path / 'maps.nii'), str(tmp_path / 'run_N.nii')]